@@ -11,7 +11,7 @@ from pathlib import Path
 from itertools import product
 
 # 01. DEFINE FUNCTIONS  ---------------------------------------------------------------------------
-def create_deviations(num_values, min_val, max_val, zero=True, N=100):
+def create_deviations(num_values, min_val, max_val, zero=True, N=100, rng=None):
 	"""
 	Generate `num_values` unique integers by sampling from a pool of log-spaced values (base 10).
 	Sampling is random and without replacement.
@@ -23,6 +23,7 @@ def create_deviations(num_values, min_val, max_val, zero=True, N=100):
 	max_val (int): The largest deviation in absolute terms.
 	zero (bool): If True, includes 0 in the resulting deviation sample.
 	N (int): The multiplier for the log-spaced pool size. Higher values are better.
+	rng (np.random.Generator): Generator of the random draws (default: a fresh, unseeded one).
 	
 	Returns
 	-------
@@ -71,14 +72,15 @@ def create_deviations(num_values, min_val, max_val, zero=True, N=100):
 		)
 
 	# Randomly sample unique values
+	rng = rng or np.random.default_rng()
 	if zero:
 		# Sample one less than `num_values` because we're adding zero
-		selected_values = np.random.choice(list(int_values), size=num_values-1, replace=False)
+		selected_values = rng.choice(list(int_values), size=num_values-1, replace=False)
 		# Add zero
 		result = np.concatenate([[0], selected_values])
 
 	else:
-		result = np.random.choice(list(int_values), size=num_values, replace=False)
+		result = rng.choice(list(int_values), size=num_values, replace=False)
 
 	return np.sort(result).tolist()
 
@@ -96,7 +98,7 @@ def calculate_trial_duration(combo, params):
 	
 	return trial_duration
 
-def create_experimental_sessions(params, sesID, save_csv=False, MAX_BLOCK_DURATION_MIN=15):
+def create_experimental_sessions(params, sesID, save_csv=False, MAX_BLOCK_DURATION_MIN=15, seed=None):
 	"""
 	Calculates all parameters required to construct trial sequences for a single 
 	experimental session. Counterbalances timing deviations and their locations 
@@ -151,6 +153,10 @@ def create_experimental_sessions(params, sesID, save_csv=False, MAX_BLOCK_DURATI
 	    If True, the generated trial parameters are saved to a .csv file.
 	MAX_BLOCK_DURATION_MIN : int
 	    The maximum recommended duration (in minutes) for a single block.
+	seed : int, np.random.SeedSequence or None
+	    Seed of all random draws of the session. The entropy and spawn key of the
+	    SeedSequence are printed, so the same session can be generated again from them.
+	    If None, fresh entropy is drawn from the operating system.
 
 	Returns
 	-------
@@ -183,6 +189,12 @@ def create_experimental_sessions(params, sesID, save_csv=False, MAX_BLOCK_DURATI
 	- **Deviation Logic**: Frequency deviations never occur on the same tone or 
 	  the immediately following tone as a time deviant.
 	"""
+	# 00. SEED ------------------------------------------------------------------------------------
+	# Every random draw of the session comes from one SeedSequence.
+	seed_seq = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+	rng = random.Random(int(seed_seq.generate_state(1, np.uint64)[0]))
+	print(f"\nSeed of session {sesID}: entropy = {seed_seq.entropy}, spawn_key = {seed_seq.spawn_key}")
+
 	# 01. GENERATE INDEPENDENT VARIABLES: Timing deviation size and location ----------------------
 	# Create negative values of tone's timing deviation. If applicable, includes a "negative" zero.
 	DEV_pos = np.array(params["DEVS"])
@@ -296,17 +308,17 @@ def create_experimental_sessions(params, sesID, save_csv=False, MAX_BLOCK_DURATI
 	# To make these parameters vary on trial-level, replace "k" with the TOTAL trial number.
 	
 	# Sample without replacement: every value is unique.
-	ISI = random.sample(
+	ISI = rng.sample(
 		range(params["ISI_MIN"], params["ISI_MAX"] + 1),
 		k=1 # For trial-level randomization: k=NO_TRIALS_ALL
 		)
-	NO_TONES = random.sample(
+	NO_TONES = rng.sample(
 		range(params["MIN_TONES"], params["MAX_TONES"] + 1),
 		k=1 # For trial-level randomization: k=NO_TRIALS_ALL
 		)
 
 	### --------------------------- Parameters that vary across trials ----------------------------
-	ITI = random.sample(
+	ITI = rng.sample(
 		range(params["ITI_MIN"], params["ITI_MAX"] + 1),
 		k=(NO_TRIALS_ALL)
 		)
@@ -353,7 +365,7 @@ def create_experimental_sessions(params, sesID, save_csv=False, MAX_BLOCK_DURATI
 		FREQ = params["FREQS"].copy()
 
 		# Randomly select one frequency standard and add to trial.
-		BASE_FREQUENCY = random.sample(FREQ, 1)
+		BASE_FREQUENCY = rng.sample(FREQ, 1)
 		trial["base_freq"] = BASE_FREQUENCY[0]
 
 		# Remove the standard as a possible frequency deviation.
@@ -373,13 +385,13 @@ def create_experimental_sessions(params, sesID, save_csv=False, MAX_BLOCK_DURATI
 			FREQ_LOC_ALL.remove(trial["dev_loc"] + 1)
 
 		# Randomly determine the number of frequency deviants for the current trial.
-		FREQ_REP = random.sample(
+		FREQ_REP = rng.sample(
 			list(range(params["FREQ_REP_MAX"] + 1)),
 			1
 			)
 		
 		# Allow random sampling with replacement for deviants.
-		FREQ_DEVS = random.choices(
+		FREQ_DEVS = rng.choices(
 			FREQ,
 			k=FREQ_REP[0]
 			)
@@ -393,7 +405,7 @@ def create_experimental_sessions(params, sesID, save_csv=False, MAX_BLOCK_DURATI
 				FREQ_DEV_TYPE.append("higher")
 		
 		# Randomly choose the location of the FREQ_DEVS (without replacement).
-		FREQ_LOC = random.sample(FREQ_LOC_ALL, FREQ_REP[0])
+		FREQ_LOC = rng.sample(FREQ_LOC_ALL, FREQ_REP[0])
 
 		# Add to current trial.
 		# If there are no FREQ_DEVS in the current trial (FREQ_REP == 0),
@@ -413,7 +425,7 @@ def create_experimental_sessions(params, sesID, save_csv=False, MAX_BLOCK_DURATI
 		COMBOS_ALL_DEV.append(trial)
 
 	# Randomly shuffle sound trials.
-	random.shuffle(COMBOS_ALL_DEV)
+	rng.shuffle(COMBOS_ALL_DEV)
 
 	# 04. CREATE SILENT TRIALS and SPLIT INTO BLOCKS ----------------------------------------------
 	# Calculate the number of silent trials needed per block.
@@ -490,7 +502,7 @@ def create_experimental_sessions(params, sesID, save_csv=False, MAX_BLOCK_DURATI
 							raise ValueError("No valid indices left (constraints too tight)")
 
 			# Chose from allowed indices
-			choice = random.choice(available) 
+			choice = rng.choice(available) 
 			
 			# Empty trials cannot occur in a row
 			choice_after  = choice + 1
@@ -661,9 +673,15 @@ if __name__ == "__main__":
 						   # Easier to count if the first 2 tones are frequency standards
 
 	"LAST_FREQ_LOC"  : 7,  # The last tone to be displaced frequency-wise
+
+	# e. Randomness
+	"SEED" : None, # Entropy of the root SeedSequence (None: drawn from the OS and printed in each .txt)
 	}
 
+	# Session n always gets child n of the root seed, so any session can be generated again on its own
+	root_seed = np.random.SeedSequence(params["SEED"])
 	for session in range(1, 10):
+		session_seed = np.random.SeedSequence(root_seed.entropy, spawn_key=(session,))
 		with open(f"trials/ses-{session:003d}_exp_parameter_combo.txt", "w") as f:
 			sys.stdout = f
-			create_experimental_sessions(params, session, save_csv=True)
\ No newline at end of file
+			create_experimental_sessions(params, session, save_csv=True, seed=session_seed)
\ No newline at end of file
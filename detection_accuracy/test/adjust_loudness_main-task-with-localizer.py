@@ -43,8 +43,11 @@ params = {
     "NUM_HARMONICS"   : 10,     # Number of harmonics
     "HARMONIC_FACTOR" : 0.8,    # Harmonic amplitude decay factor
     "MAX_AMPLITUDE"   : 1.14,   # Defined through a simulation
-    "SAMPLE_RATE"     : 48000,  # Hz
+    "SAMPLE_RATE"     : 48000,  # Hz, tones are synthesized at this rate
+    "DEVICE_RATE"     : 48000,  # Hz, change depending on the speakers (tones are resampled)
     "TAU"             : 5,      # Ramping window in msec
+    "AUDIO_DTYPE"     : "float32", # Played by sounddevice without conversion
+    "BLOCK_CACHE_DIR" : "block_cache", # Rendered blocks, reused on reruns of this script (in PROJECT_ROOT)
 
 	# Audio for localizer
 	"SOUND_DURATION"   : 1000, # msec
@@ -98,7 +101,8 @@ for s in sounds.values():
     s.preload()
 
 # Get sounds for main task: initialize soung generation (SoundGen) class
-sound_gen = sg.SoundGen(params["SAMPLE_RATE"], params["TAU"])
+sound_gen = sg.SoundGen(params["SAMPLE_RATE"], params["TAU"], dtype=params["AUDIO_DTYPE"], device_rate=params["DEVICE_RATE"])
+block_cache = sg.BlockCache(homePath / params["BLOCK_CACHE_DIR"])
 
 # 05. RUN THE EXPERIMENT ---------------------------------------------------------------------------
 # Start the loudness adjustment.
@@ -135,13 +139,13 @@ for block in range(no_blocks):
 
     # Play all tone sequences: trial by trial
     block_start_time = exp.clock.time - task_start_time
-    for soundtrack, ITI, freq_dev_no, trial_log in sound_gen.generate_soundtrack(df_block, block_start_time, params["MAX_AMPLITUDE"], params["NUM_HARMONICS"],  params["TONE_DURATION"],  params["HARMONIC_FACTOR"], params["TONE_LOUDNESS"]):
+    for soundtrack, ITI, freq_dev_no, trial_log, time_end in sound_gen.generate_soundtrack(df_block, block_start_time, params["MAX_AMPLITUDE"], params["NUM_HARMONICS"],  params["TONE_DURATION"],  params["HARMONIC_FACTOR"], params["TONE_LOUDNESS"], block_cache=block_cache):
 
         key, rt = keyboard.wait(keys = [misc.constants.K_g, misc.constants.K_e])
 
         # Play sounds when 'g' is pressed (GO).
         if key == 103: # ASCII code
-            sd.play(soundtrack, samplerate = params["SAMPLE_RATE"])
+            sd.play(soundtrack, samplerate = params["DEVICE_RATE"])
             sd.wait()
         
         # End loudness check when 'e' is pressed (END).
@@ -3,43 +3,596 @@
 '''
 create_soundtrack_soundgen() module generates sounds as defined in csv.
 '''
+import json
+import time
+import hashlib
+import queue
 import warnings
+import threading
 import numpy as np
+from math import gcd
+from fractions import Fraction
 import pandas as pd
 from pathlib import Path
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import sounddevice as sd
 import ast
+from pcm import quantize_pcm
 
 # TODO: replace set_dbspl() with Jasmin's code for sound normalization
-def set_dbspl(sound, dbspl, ref=20e-6):
+def set_dbspl(sound, dbspl, ref=20e-6, rms=None, out=None):
     """
     Normalize waveform to target dB SPL.
 
-    :param sound : np.array, input waveform
-    :param dbspl: float, desired sound level in dB SPL
+    :param sound : np.array, input waveform (1D, or 2D with one tone per row)
+    :param dbspl: float, desired sound level in dB SPL (for 2D input: one value per row, shape (tones, 1))
     :param ref: float, reference pressure (default 20 µPa)
+    :param rms: float or array, RMS of the input waveform if already known (e.g. from harmonic_rms)
+    :param out: np.array, optional array of the same shape to write the result into (may be sound itself)
+
+    The output keeps the dtype of the input waveform.
     """
 
-    # Apply dB SPL scaling (RMS based)
-    rms = np.sqrt(np.mean(sound**2))
-    target_rms = ref * (10 ** (dbspl / 20))
-    scale = target_rms / rms
-    scaled_sound = sound * scale
+    # Apply dB SPL scaling (RMS based). For 2D input (tones x samples),
+    # each row is normalized separately.
+    if rms is None:
+        rms = np.sqrt(np.mean(sound**2, axis=-1, keepdims=True))
+    target_rms = ref * (10 ** (np.asarray(dbspl) / 20))
+    scale = np.asarray(target_rms / rms, dtype=sound.dtype)
+    scaled_sound = np.multiply(sound, scale, out=out)
 
     return scaled_sound
 
+def harmonic_rms(freqs, amplitudes, n_samples, dt):
+    """
+    RMS of sampled harmonic complex tones, computed from the harmonic amplitudes.
+
+    For a whole number of periods the RMS is sqrt(sum(a**2) / 2). For any other
+    length, the cross terms between harmonics do not average out; they are
+    included exactly with the closed form of the mean of cos(alpha * n) over
+    n = 0 .. N-1 (Dirichlet kernel), so no waveform is needed.
+
+    :param freqs: 1D array of base frequencies in Hz.
+    :param amplitudes: Amplitude of every harmonic (first one is the base frequency).
+    :param n_samples: Number of samples of the tones.
+    :param dt: Time between samples in seconds.
+
+    :return: rms: an array with the RMS of each tone, shape (tones, 1).
+    """
+    def mean_cos(cycles):
+        # mean(cos(alpha * n)) = sin(N alpha / 2) cos((N - 1) alpha / 2) / (N sin(alpha / 2)),
+        # with alpha = 2 pi cycles; it is 1 if alpha is a multiple of 2 pi.
+        alpha = 2 * np.pi * np.mod(cycles, 1)
+        half_sin = np.sin(alpha / 2)
+        whole_cycles = np.abs(half_sin) < 1e-12
+        safe = np.where(whole_cycles, 1, half_sin)
+        mean = np.sin(n_samples * alpha / 2) * np.cos((n_samples - 1) * alpha / 2) / (n_samples * safe)
+        return np.where(whole_cycles, 1.0, mean)
+
+    k = np.arange(1, len(amplitudes) + 1)
+    cycles_per_sample = np.asarray(freqs, dtype=float)[:, None, None] * dt
+
+    # mean(sin(j x) sin(k x)) = (mean(cos((j - k) x)) - mean(cos((j + k) x))) / 2
+    products = (
+        mean_cos((k[:, None] - k[None, :]) * cycles_per_sample)
+        - mean_cos((k[:, None] + k[None, :]) * cycles_per_sample)
+        ) / 2
+    mean_square = np.einsum("j,fjk,k->f", amplitudes, products, amplitudes)
+    mean_square = np.maximum(mean_square, 0) # rounding
+
+    return np.sqrt(mean_square)[:, None]
+
+# Everything that defines a ramped tone. Durations (duration, tau) are in seconds.
+ToneSpec = namedtuple(
+    "ToneSpec",
+    ["freq", "max_amplitude", "num_harmonics", "duration", "harmonic_factor", "dbspl", "sample_rate", "tau", "ramp"],
+    defaults=["sin2"]
+    )
+
+# One row per tone of a session (see SoundGen.compile_timeline)
+TIMELINE_DTYPE = np.dtype([
+    ("block",    np.int32),
+    ("trial",    np.int32),
+    ("tone",     np.int16),   # 1-based position in the trial
+    ("onset",    np.float64), # tone onset in samples at the device rate
+    ("offset",   np.float64), # tone offset in samples (for the last tone: end of the trial)
+    ("freq_idx", np.int16),   # index into the session frequencies, -1 for silence
+    ("t_dev",    np.bool_),   # timing deviant (early or late tone)
+    ("f_dev",    np.bool_),   # frequency deviant
+    ("silent",   np.bool_),   # silent trial
+    ("muted",    np.bool_),   # no audio: trial without dev_loc (silent and on-time trials)
+    ])
+
+class RampLibrary:
+
+    # Available window shapes for the onset/offset ramps
+    SHAPES = ("sin2", "raised_cosine", "hann", "gaussian", "linear")
+
+    def __init__(self):
+        """
+        Onset ramps (fade-in windows), built once per (shape, tau, sample rate, dtype).
+        The fade-out is the reversed fade-in.
+        """
+        self._windows = {}
+
+    def window(self, shape, tau, sample_rate, dtype=np.float64):
+        """
+        Return the read-only fade-in window of L = int(tau * sample_rate) samples.
+
+        :param shape: Window shape:
+            "sin2" sin(pi t / (2 tau))**2 on np.linspace(0, L / sample_rate, L) (the original sine_ramp),
+            "raised_cosine" 0.5 * (1 - cos(pi n / L)) for n = 0 .. L-1,
+            "hann" the first half of a symmetric Hann window of 2L samples (np.hanning),
+            "gaussian" the rising half of a Gaussian with sigma = L / 3, shifted and scaled
+                to start at 0 (instead of exp(-4.5) at 3 sigma) and reach 1 at n = L,
+            "linear" a straight line from 0 to 1.
+        :param tau: The ramping window in seconds.
+        :param sample_rate: Sample rate in Hz.
+        :param dtype: dtype of the window.
+        """
+        key = (shape, tau, sample_rate, np.dtype(dtype))
+        window = self._windows.get(key)
+        if window is not None:
+            return window
+
+        L = int(tau * sample_rate)
+        n = np.arange(L)
+        if shape == "sin2":
+            t = np.linspace(0, L / sample_rate, L)
+            window = np.sin(np.pi * t / (2 * tau)) ** 2
+        elif shape == "raised_cosine":
+            window = 0.5 * (1 - np.cos(np.pi * n / L))
+        elif shape == "hann":
+            window = np.hanning(2 * L)[:L]
+        elif shape == "gaussian":
+            floor = np.exp(-0.5 * 3 ** 2) # value at n = 0
+            window = (np.exp(-0.5 * ((n - L) / (L / 3)) ** 2) - floor) / (1 - floor)
+        elif shape == "linear":
+            window = np.linspace(0, 1, L)
+        else:
+            raise ValueError(f"Unknown ramp shape '{shape}'. Choose from {self.SHAPES}.")
+
+        window = window.astype(dtype)
+        window.flags.writeable = False
+        self._windows[key] = window
+
+        return window
+
+    def apply(self, sound, shape, tau, sample_rate):
+        """ Ramp the first and last L samples of sound in place. """
+        window = self.window(shape, tau, sample_rate, sound.dtype)
+        L = len(window)
+        if L:
+            sound[:L] *= window         # Apply fade-in
+            sound[-L:] *= window[::-1]  # Apply fade-out
+
+        return sound
+
+# Ramps are shared by all SoundGen instances
+RAMPS = RampLibrary()
+
+class PolyphaseResampler:
+    def __init__(self, from_rate, to_rate):
+        """
+        Polyphase resampling from from_rate to to_rate (e.g. 48000 -> 44100 Hz).
+
+        The anti-aliasing filter is designed once (same design as the default of
+        scipy.signal.resample_poly) and reused for every call.
+
+        :param from_rate: Sample rate of the input in Hz.
+        :param to_rate: Sample rate of the output in Hz.
+        """
+        from scipy import signal # only needed when the device rate differs
+
+        divisor = gcd(int(from_rate), int(to_rate))
+        self.up = int(to_rate) // divisor
+        self.down = int(from_rate) // divisor
+        self._resample_poly = signal.resample_poly
+
+        # Low-pass filter at the lower of the two Nyquist frequencies
+        max_rate = max(self.up, self.down)
+        half_len = 10 * max_rate
+        self.filter = signal.firwin(2 * half_len + 1, 1 / max_rate, window=("kaiser", 5.0))
+
+    def __call__(self, sound, n_samples=None):
+        """
+        Resample sound; if given, the output is cut or zero-padded to n_samples.
+        """
+        resampled = self._resample_poly(sound, self.up, self.down, window=self.filter)
+        if n_samples is not None:
+            resampled = resampled[:n_samples]
+            if len(resampled) < n_samples:
+                resampled = np.pad(resampled, (0, n_samples - len(resampled)))
+
+        return resampled.astype(sound.dtype, copy=False)
+
+class FractionalDelayBank:
+    def __init__(self, phases=256, half_len=16, beta=8.0):
+        """
+        Polyphase bank of windowed-sinc fractional-delay filters.
+
+        Filter p delays a signal by p / phases samples, so placing a tone at a
+        non-integer onset is one table lookup and one short convolution.
+
+        :param phases: Number of fractional delays per sample (resolution 1 / phases samples).
+        :param half_len: Half the number of filter taps.
+        :param beta: Shape parameter of the Kaiser window.
+        """
+        self.phases = phases
+        self.half_len = half_len
+
+        # Tap k (k = -half_len + 1 .. half_len) of filter p is sinc(k - p / phases)
+        k = np.arange(-half_len + 1, half_len + 1)
+        delays = np.arange(phases)[:, None] / phases
+        filters = np.sinc(k[None, :] - delays) * np.kaiser(2 * half_len, beta)[None, :]
+        filters /= filters.sum(axis=1, keepdims=True) # unity gain at DC
+        filters.flags.writeable = False
+        self.filters = filters
+
+    def place(self, buffer, sound, onset):
+        """
+        Add sound to buffer, starting at the (non-integer) sample onset.
+
+        Onsets within 1 / (2 phases) samples of an integer are placed by a plain copy.
+        Samples of the filtered sound outside the buffer are dropped.
+
+        :param buffer: 1D float array to add the sound into.
+        :param sound: 1D array with the sound.
+        :param onset: Onset in samples (float).
+        """
+        start = int(np.floor(onset))
+        phase = int(round((onset - start) * self.phases))
+        if phase == self.phases:
+            start, phase = start + 1, 0
+
+        if phase == 0:
+            stop = min(start + len(sound), len(buffer))
+            buffer[start:stop] += sound[:stop - start]
+            return buffer
+
+        # Output sample i of the full convolution lies at start + i - (half_len - 1)
+        delayed = np.convolve(sound, self.filters[phase].astype(buffer.dtype, copy=False))
+        first = start - (self.half_len - 1)
+        lo, hi = max(first, 0), min(first + len(delayed), len(buffer))
+        buffer[lo:hi] += delayed[lo - first:hi - first]
+
+        return buffer
+
+class ToneBank:
+    def __init__(self, max_bytes=64 * 1024**2):
+        """
+        Cache of ramped tones, keyed by ToneSpec.
+
+        A session only uses a handful of unique tones, so every tone is
+        synthesized once and reused. Cached tones are read-only. When the
+        cache grows above max_bytes, the least recently used tones are dropped.
+        The cache can be shared by threads (see SoundGen.render_session).
+
+        :param max_bytes: Memory limit of the cache in bytes (0 disables caching).
+        """
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._tones = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._tones)
+
+    def __contains__(self, spec):
+        return spec in self._tones
+
+    def get(self, spec):
+        """ Return the cached tone for spec (or None) and count the hit/miss. """
+        with self._lock:
+            tone = self._tones.get(spec)
+            if tone is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._tones.move_to_end(spec) # most recently used
+        return tone
+
+    def put(self, spec, tone):
+        """ Store a read-only copy of the tone and evict the least recently used tones. """
+        # Tones larger than the whole cache are not stored
+        if tone.nbytes > self.max_bytes:
+            return tone
+
+        tone = np.array(tone, copy=True)
+        tone.flags.writeable = False
+
+        with self._lock:
+            if spec in self._tones:
+                self.nbytes -= self._tones.pop(spec).nbytes
+
+            self._tones[spec] = tone
+            self.nbytes += tone.nbytes
+
+            # Evict least recently used tones
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._tones.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+        return tone
+
+    def clear(self):
+        """ Drop all tones (the hit/miss counters are kept). """
+        with self._lock:
+            self._tones.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        """ Return cache counters as a dictionary. """
+        return {
+            "tones": len(self._tones),
+            "nbytes": self.nbytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            }
+
 class SoundGen:
-    def __init__(self, sample_rate, tau):
+
+    # Available synthesis kernels for the harmonics
+    KERNELS = ("sin", "recurrence", "irfft")
+
+    # Available ways to compute the RMS for the dB SPL normalization
+    RMS_MODES = ("analytic", "numeric", "verify")
+
+    # Markers of the sync channel: a pulse at every tone onset, a pulse train at every trial start
+    SYNC_PULSE = 1        # msec, duration of one pulse (and of the gap between pulses of a train)
+    SYNC_TRIAL_PULSES = 3 # pulses in the train at the start of a trial
+    SYNC_LEVEL = 0.9      # pulse amplitude (full scale = 1.0)
+
+    def __init__(self, sample_rate, tau, cache_bytes=64 * 1024**2, kernel="sin", fft_tolerance=0.0, tile=False,
+                 rms="analytic", dtype=np.float64, pcm_bits=None, ramp_shape="sin2", device_rate=None,
+                 fractional=False, seed=None, sync=False):
         """
         Initialize the CreateSound instance.
 
         :param sample_rate: Sample rate of sounds in Hz.
         :param tau: The ramping window in milliseconds.
+        :param cache_bytes: Memory limit of each tone cache (float and PCM ToneBank) in bytes.
+        :param kernel: Synthesis kernel for the harmonics:
+            "sin" evaluates np.sin once per harmonic,
+            "recurrence" evaluates sin and cos once and derives all other harmonics,
+            "irfft" places the harmonics in a spectrum and uses one inverse FFT.
+        :param fft_tolerance: Max. shift of the base frequency in Hz allowed when rounding
+            it to the nearest exact FFT bin ("irfft" kernel only). With 0, only tones
+            with a whole number of cycles use the FFT.
+        :param tile: If True, periodic tones are synthesized for one (super-)period only
+            and repeated to the full tone duration.
+        :param rms: How the RMS for the dB SPL normalization is computed:
+            "analytic" from the harmonic amplitudes (no pass over the waveform) where possible,
+            "numeric" from the waveform,
+            "verify" from the waveform, with a warning if the analytic value disagrees.
+        :param dtype: Floating point type of all generated audio (np.float32 halves the memory
+            and is what sounddevice plays without conversion).
+        :param pcm_bits: If 16 or 24, generate_soundtrack yields dithered integer PCM (see quantize_pcm)
+            instead of floats. Quantized tones are cached next to the float tones.
+        :param ramp_shape: Shape of the onset/offset ramps (see RampLibrary.SHAPES).
+        :param device_rate: Sample rate of the playback device in Hz. Tones are always
+            synthesized at sample_rate and resampled (cached) to device_rate;
+            generate_soundtrack works in samples of the device rate.
+        :param fractional: If True, generate_soundtrack places tones at their exact (non-integer)
+            onsets with a FractionalDelayBank. ISI and DEV are not truncated to whole samples.
+            Not available for PCM output.
+        :param seed: Seed (int or np.random.SeedSequence) of the PCM dither. self.seed_sequence.entropy
+            records it; None draws fresh entropy from the OS. Float output does not use it.
+        :param sync: If True, the rendered audio has a second channel with sync markers: a pulse
+            at every tone onset and a pulse train at every trial start (also of silent trials),
+            written while the tones are placed. Recorded with the scanner triggers, it gives the
+            true onset latency and jitter of the sound card. Arrays are then (samples x 2).
         """
+        if kernel not in self.KERNELS:
+            raise ValueError(f"Unknown synthesis kernel '{kernel}'. Choose from {self.KERNELS}.")
+        if rms not in self.RMS_MODES:
+            raise ValueError(f"Unknown RMS mode '{rms}'. Choose from {self.RMS_MODES}.")
+        if ramp_shape not in RampLibrary.SHAPES:
+            raise ValueError(f"Unknown ramp shape '{ramp_shape}'. Choose from {RampLibrary.SHAPES}.")
+        if fractional and pcm_bits:
+            raise ValueError("Fractional onsets need float output; use pcm_bits=None.")
+
         self.sample_rate = sample_rate
         self.tau = tau / 1000 # convert to sec
-    
-    def sound_maker(self, freq, max_amplitude, num_harmonics, tone_duration, harmonic_factor, dbspl):
+        self.kernel = kernel
+        self.fft_tolerance = fft_tolerance
+        self.tile = tile
+        self.rms = rms
+        self.dtype = np.dtype(dtype)
+        self.pcm_bits = pcm_bits
+        self.ramp_shape = ramp_shape
+        self.output_rate = device_rate or sample_rate
+        self.fractional = fractional
+        self.delays = FractionalDelayBank() if fractional else None
+        self.sync = sync
+        self._resamplers = {} # one per device rate
+        self.seed_sequence = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+        self.tone_bank = ToneBank(cache_bytes)
+        self.pcm_bank = ToneBank(cache_bytes)
+
+        # Clipping report of all quantized tones
+        self.pcm_report = {"tones": 0, "clipped": 0, "peak": 0.0}
+
+        # Render time of every trial of generate_soundtrack rendered on its own (see _guarded_soundtrack)
+        self.budget_report = []
+
+        # Markers of the sync channel in the output dtype
+        self.sync_markers = self._sync_markers() if sync else None
+
+    def _phase(self, freqs, t):
+        """
+        Phase 2 pi f t of each base frequency (tones x samples) in the dtype of the instance.
+        For single precision, the phase is computed in float64 and wrapped to one cycle
+        before the cast, so long tones keep an accurate phase.
+        """
+        x = 2 * np.pi * np.asarray(freqs, dtype=float)[:, None] * np.asarray(t, dtype=float)[None, :]
+        if self.dtype != np.float64:
+            x = np.mod(x, 2 * np.pi).astype(self.dtype)
+        return x
+
+    def _harmonics_sin(self, freqs, t, amplitudes):
+        """ Sum the harmonics on a (tones x harmonics x samples) grid, one np.sin per harmonic. """
+        amplitudes = np.asarray(amplitudes, dtype=self.dtype)
+        k = np.arange(1, len(amplitudes) + 1, dtype=self.dtype)
+        harmonics = np.sin(k[None, :, None] * self._phase(freqs, t)[:, None, :])
+
+        return np.einsum("h,fhn->fn", amplitudes, harmonics)
+
+    def _harmonics_recurrence(self, freqs, t, amplitudes):
+        """
+        Sum the harmonics using the Chebyshev recurrence
+        sin((k+1)x) = 2 cos(x) sin(kx) - sin((k-1)x),
+        so only one sin and one cos are evaluated per tone.
+        """
+        amplitudes = np.asarray(amplitudes, dtype=self.dtype)
+        x = self._phase(freqs, t)
+        sin_k = np.sin(x)           # sin(1x)
+        sin_prev = np.zeros_like(x) # sin(0x)
+        two_cos = 2 * np.cos(x)
+
+        sound = amplitudes[0] * sin_k
+        for amplitude in amplitudes[1:]:
+            sin_next = two_cos * sin_k
+            sin_next -= sin_prev
+            sin_prev, sin_k = sin_k, sin_next
+            sound += amplitude * sin_k
+
+        return sound
+
+    def _harmonics_irfft(self, freqs, t, amplitudes):
+        """
+        Build the harmonic complex tones in the frequency domain.
+
+        A harmonic falls exactly on an FFT bin when the tone contains a whole
+        number of cycles of the base frequency. The base frequency is rounded
+        to the nearest bin if the shift is within fft_tolerance; otherwise
+        (or if the top harmonic is above Nyquist) the tone falls back to
+        time-domain synthesis with the "recurrence" kernel.
+        """
+        n_samples = len(t)
+        duration = n_samples * (t[1] - t[0]) if n_samples > 1 else 0
+        k = np.arange(1, len(amplitudes) + 1)
+
+        # Number of cycles of the base frequency in the tone = FFT bin of the base frequency
+        cycles = freqs * duration
+        bins = np.round(cycles).astype(int)
+        shift_hz = np.abs(bins - cycles) / duration if duration else np.full(freqs.shape, np.inf)
+        exact = (bins >= 1) & (shift_hz <= self.fft_tolerance + 1e-9) & (bins * k[-1] < n_samples / 2)
+
+        sounds = np.empty((len(freqs), n_samples), dtype=self.dtype)
+
+        # Spectrum: a * sin(2 pi k b n / N) corresponds to -1j * a * N / 2 at bin k * b
+        if exact.any():
+            spectrum = np.zeros((exact.sum(), n_samples // 2 + 1), dtype=np.result_type(self.dtype, np.complex64))
+            rows = np.arange(exact.sum())[:, None]
+            spectrum[rows, bins[exact][:, None] * k[None, :]] = -1j * amplitudes * n_samples / 2
+            sounds[exact] = np.fft.irfft(spectrum, n=n_samples, axis=-1)
+
+        # Fall back to time-domain synthesis
+        if not exact.all():
+            sounds[~exact] = self._harmonics_recurrence(freqs[~exact], t, amplitudes)
+
+        return sounds
+
+    def _period_samples(self, freq, t):
+        """
+        Return the smallest number of samples after which the tone repeats exactly,
+        or None if there is no such period of at most half the tone length.
+        A harmonic complex repeats with the period of its base frequency, so the
+        tone repeats after P samples when P * freq * dt is a whole number of cycles.
+        """
+        n_samples = len(t)
+        if n_samples < 4:
+            return None
+
+        # Cycles of the base frequency per sample as a fraction (numerator / denominator)
+        cycles_per_sample = freq * (t[1] - t[0])
+        ratio = Fraction(cycles_per_sample).limit_denominator(n_samples // 2)
+
+        # The phase error accumulated over the whole tone must be negligible
+        if ratio.numerator == 0 or abs(float(ratio) - cycles_per_sample) * n_samples > 1e-9:
+            return None
+
+        return ratio.denominator
+
+    def _synthesize_tiled(self, freqs, t, amplitudes, kernel):
+        """ Synthesize one period of each tone and repeat it (falls back to direct synthesis). """
+        sounds = np.empty((len(freqs), len(t)), dtype=self.dtype)
+        direct = []
+
+        for row, freq in enumerate(freqs):
+            period = self._period_samples(freq, t)
+            if period is None:
+                direct.append(row)
+                continue
+
+            one_period = self._synthesize(freqs[row:row + 1], t[:period], amplitudes, kernel, tile=False)[0]
+            sounds[row] = np.resize(one_period, len(t)) # repeats the period to the full length
+
+        if direct:
+            sounds[direct] = self._synthesize(freqs[direct], t, amplitudes, kernel, tile=False)
+
+        return sounds
+
+    def _synthesize(self, freqs, t, amplitudes, kernel=None, tile=None):
+        """
+        Sum the harmonics of every frequency in freqs with the selected kernel.
+
+        :param freqs: 1D array of base frequencies in Hz.
+        :param t: Time array in seconds (float64, also for single precision synthesis).
+        :param amplitudes: Amplitude of every harmonic (first one is the base frequency).
+        :param kernel: Override the kernel of the instance.
+        :param tile: Override the tiling setting of the instance.
+
+        :return: sounds: a 2D array (tones x samples) of un-normalized harmonic complex tones.
+        """
+        kernel = kernel or self.kernel
+        tile = self.tile if tile is None else tile
+
+        if tile:
+            return self._synthesize_tiled(freqs, t, amplitudes, kernel)
+
+        if kernel == "recurrence":
+            return self._harmonics_recurrence(freqs, t, amplitudes)
+
+        if kernel == "irfft":
+            return self._harmonics_irfft(freqs, t, amplitudes)
+
+        return self._harmonics_sin(freqs, t, amplitudes)
+
+    def _normalize(self, sounds, freqs, t, amplitudes, dbspl, out=None):
+        """
+        Normalize un-ramped harmonic complex tones (one per row) to the target dB SPL.
+
+        The analytic RMS is used unless a harmonic is at or above Nyquist or
+        the "irfft" kernel may have moved the base frequency to another bin.
+        The result is written into out if given (same shape as sounds).
+        """
+        analytic = (
+            self.rms != "numeric"
+            and len(t) > 1
+            and np.all(freqs * len(amplitudes) * (t[1] - t[0]) < 0.5)
+            and not (self.kernel == "irfft" and self.fft_tolerance > 0)
+            )
+        if not analytic:
+            return set_dbspl(sounds, dbspl, out=out)
+
+        rms = harmonic_rms(freqs, amplitudes, len(t), t[1] - t[0])
+
+        # Verification mode: use the numeric RMS, but check the analytic one
+        if self.rms == "verify":
+            numeric_rms = np.sqrt(np.mean(sounds**2, axis=-1, keepdims=True))
+            error = np.max(np.abs(rms - numeric_rms) / numeric_rms)
+            if error > max(1e-9, 1000 * np.finfo(self.dtype).eps):
+                warnings.warn(f"Analytic RMS differs from numeric RMS (relative error {error:.2e}).", UserWarning)
+            rms = numeric_rms
+
+        return set_dbspl(sounds, dbspl, rms=rms, out=out)
+
+    def sound_maker(self, freq, max_amplitude, num_harmonics, tone_duration, harmonic_factor, dbspl, out=None):
         """
         Make a single normalized sound.
 
@@ -49,8 +602,10 @@ class SoundGen:
         :param tone_duration: Duration of the tone in seconds.
         :param harmonic_factor: Harmonic amplitude decay factor for the tone.
         :param dbspl: Desired dB SPL (loudness) level (cannot change post sound creation).
+        :param out: Optional 1D array of int(sample_rate * tone_duration) samples to write the sound into,
+            e.g. a slice of a preallocated sequence buffer.
         
-        :return: normalized_sound: an array of audio samples representing a harmonic complex tone.
+        :return: normalized_sound: an array of audio samples representing a harmonic complex tone (out if given).
         """
         
         # Create a time array: each sample represents one event per second 
@@ -61,54 +616,236 @@ class SoundGen:
             endpoint = False                       # stop is not the last sample
             )
         
-        # Initialize a sound array
-        sound = np.zeros_like(t)
+        # Amplitude of each harmonic
+        k = np.arange(1, num_harmonics + 1)
+        amplitudes = max_amplitude * (harmonic_factor ** (k - 1)) / num_harmonics
 
         # Generate the harmonics
-        for k in range(1, num_harmonics + 1):
-            harmonic  = np.sin(2 * np.pi * freq * k * t)
-            amplitude = max_amplitude * (harmonic_factor ** (k - 1)) / num_harmonics
-            sound += amplitude * harmonic
+        freqs = np.array([freq], dtype=float)
+        sound = self._synthesize(freqs, t, amplitudes)
+
+        # Normalize the sound (into the caller's buffer if given)
+        if out is not None:
+            if out.shape != t.shape:
+                raise ValueError(f"out has shape {out.shape}, but the tone has {len(t)} samples.")
+            self._normalize(sound, freqs, t, amplitudes, dbspl, out=out[None, :])
+            return out
 
-        # Normalize the sound
-        normalized_sound = set_dbspl(sound, dbspl)
+        normalized_sound = self._normalize(sound, freqs, t, amplitudes, dbspl)[0]
         
         return normalized_sound
 
-    def sine_ramp(self, sound):
-        """ Apply ramping to the start and end of the sound """
+    def sound_maker_batch(self, freqs, max_amplitude, num_harmonics, tone_duration, harmonic_factor, dbspl):
+        """
+        Make many normalized sounds at once (vectorized version of sound_maker).
 
-        L = int(self.tau * self.sample_rate)
-        t = np.linspace(0, L / self.sample_rate, L)
-        sine_window = np.sin(np.pi * t / (2 * self.tau)) ** 2  # Sine fade-in
+        All tones share the time array, number of harmonics and decay factor,
+        so the harmonics are computed in one pass over a
+        (tones x harmonics x samples) grid (or tones x samples for the
+        "recurrence" kernel). Repeated frequencies are only synthesized once
+        and then normalized separately.
 
-        sound = sound.copy()
-        sound[:L] *= sine_window         # Apply fade-in
-        sound[-L:] *= sine_window[::-1]  # Apply fade-out
+        :param freqs: Sequence of tone frequencies in Hz.
+        :param max_amplitude: Maximum amplitude to avoid clipping.
+        :param num_harmonics: Number of harmonic tones.
+        :param tone_duration: Duration of the tones in seconds.
+        :param harmonic_factor: Harmonic amplitude decay factor for the tones.
+        :param dbspl: Desired dB SPL (loudness) level, either one value or one value per tone.
 
-        return sound
+        :return: normalized_sounds: a 2D array (tones x samples), one harmonic complex tone per row.
+        """
+        freqs = np.asarray(freqs, dtype=float).ravel()
+        dbspl = np.broadcast_to(np.asarray(dbspl, dtype=float), freqs.shape)
+
+        # Create a time array (same as in sound_maker)
+        t = np.linspace(0, tone_duration, int(self.sample_rate * tone_duration), endpoint = False)
+
+        # Synthesize every unique frequency only once
+        unique_freqs, inverse = np.unique(freqs, return_inverse=True)
 
-    def generate_soundtrack(self, df, current_time, max_amplitude, num_harmonics, tone_duration, harmonic_factor, dbspl):
+        # Amplitude of each harmonic
+        k = np.arange(1, num_harmonics + 1)
+        amplitudes = max_amplitude * (harmonic_factor ** (k - 1)) / num_harmonics
+
+        # Generate the harmonics of all tones at once
+        sounds = self._synthesize(unique_freqs, t, amplitudes)
+
+        # Expand to the requested tone order and normalize each row
+        normalized_sounds = self._normalize(sounds[inverse], freqs, t, amplitudes, dbspl[:, None])
+
+        return normalized_sounds
+
+    def kernel_error(self, freq, max_amplitude, num_harmonics, tone_duration, harmonic_factor, dbspl):
         """
-        Generate tone sequences with timing deviants for current trial.
+        Compare the selected kernel (and tiling) against the reference "sin" kernel.
 
-        :param df: A dataframe with tone sequence parameters with msec as the time unit.
-        :param current_time: Current time in the experiment in sec, relative to start of the task.
-        :param max_amplitude: Maximum amplitude to avoid clipping.
-        :param num_harmonics: Number of harmonic tones.
-        :param tone_duration: Duration of the tone in milliseconds.
-        :param harmonic_factor: Harmonic amplitude decay factor for the tone.
-        :param dbspl: Desired dB SPL (loudness) level (cannot change post sound creation).
-        
-        :yield: final_sequence: An array of audio samples, representing harmonic a complex tone sequence.
+        Same parameters as sound_maker (tone_duration in seconds).
+
+        :return: max_error: maximum absolute difference between the two normalized sounds.
         """
-        current_time = current_time / 1000
-        current_time = current_time * self.sample_rate
+        t = np.linspace(0, tone_duration, int(self.sample_rate * tone_duration), endpoint = False)
+        k = np.arange(1, num_harmonics + 1)
+        amplitudes = max_amplitude * (harmonic_factor ** (k - 1)) / num_harmonics
+        freqs = np.array([freq], dtype=float)
 
-        # Get number of trials per block
-        no_trials = len(df["trial_no"].unique())
-        
-        # Reminder to yourself that we're assuming msec as unit for ISI, ITI, and DEV
+        reference = set_dbspl(self._synthesize(freqs, t, amplitudes, kernel="sin", tile=False), dbspl)
+        selected  = set_dbspl(self._synthesize(freqs, t, amplitudes), dbspl)
+
+        return float(np.max(np.abs(selected - reference)))
+
+    def sine_ramp(self, sound, inplace=False, out=None):
+        """
+        Apply ramping to the start and end of the sound.
+
+        The window (ramp_shape, sin2 by default) comes from the shared RampLibrary.
+        With inplace=True, only the first and last L samples of sound are changed
+        and no copy is made. With out (an array of the same length, e.g. a slice of
+        a sequence buffer), the sound is copied into out and ramped there.
+        """
+        if out is not None:
+            if out is not sound:
+                out[...] = sound
+            sound = out
+        elif not inplace:
+            sound = sound.astype(self.dtype) # copy
+
+        return RAMPS.apply(sound, self.ramp_shape, self.tau, self.sample_rate)
+
+    def _tone_spec(self, freq, max_amplitude, num_harmonics, tone_duration, harmonic_factor, dbspl):
+        """ Cache key of a ramped tone. """
+        return ToneSpec(
+            float(freq), max_amplitude, num_harmonics, tone_duration,
+            harmonic_factor, dbspl, self.sample_rate, self.tau, self.ramp_shape
+            )
+
+    def ramped_tone(self, freq, max_amplitude, num_harmonics, tone_duration, harmonic_factor, dbspl):
+        """
+        Make a single normalized and ramped sound, reusing it from the tone cache if possible.
+
+        Same parameters as sound_maker (tone_duration in seconds).
+
+        :return: ramped_sound: a read-only array of audio samples (if cached).
+        """
+        spec = self._tone_spec(freq, max_amplitude, num_harmonics, tone_duration, harmonic_factor, dbspl)
+
+        ramped_sound = self.tone_bank.get(spec)
+        if ramped_sound is None:
+            sound = self.sound_maker(freq, max_amplitude, num_harmonics, tone_duration, harmonic_factor, dbspl)
+            ramped_sound = self.tone_bank.put(spec, self.sine_ramp(sound, inplace=True))
+
+        return ramped_sound
+
+    def device_tone(self, freq, max_amplitude, num_harmonics, tone_duration, harmonic_factor, dbspl):
+        """
+        Make a single ramped sound at the device rate (output_rate), reusing it from the tone cache if possible.
+
+        Same parameters as sound_maker (tone_duration in seconds).
+        If the device rate differs from sample_rate, the ramped tone is resampled once
+        and the result is cached under (spec, output_rate).
+
+        :return: ramped_sound: a read-only array of audio samples at the device rate (if cached).
+        """
+        if self.output_rate == self.sample_rate:
+            return self.ramped_tone(freq, max_amplitude, num_harmonics, tone_duration, harmonic_factor, dbspl)
+
+        spec = self._tone_spec(freq, max_amplitude, num_harmonics, tone_duration, harmonic_factor, dbspl)
+        key = (spec, self.output_rate)
+
+        resampled = self.tone_bank.get(key)
+        if resampled is None:
+            resampler = self._resamplers.get(self.output_rate)
+            if resampler is None:
+                resampler = PolyphaseResampler(self.sample_rate, self.output_rate)
+                self._resamplers[self.output_rate] = resampler
+
+            sound = self.ramped_tone(freq, max_amplitude, num_harmonics, tone_duration, harmonic_factor, dbspl)
+            resampled = resampler(sound, int(tone_duration * self.output_rate))
+            resampled = self.tone_bank.put(key, resampled)
+
+        return resampled
+
+    def _dither_rng(self, spec):
+        """
+        Random generator of the dither of one tone. It is a child of the seed keyed by
+        the tone (and device rate), so the dither of a tone does not depend on which
+        tones were quantized before it (cache hits, prefetching, block order).
+        """
+        digest = hashlib.sha256(repr((spec, self.output_rate, self.pcm_bits)).encode()).digest()
+        child = np.random.SeedSequence(self.seed_sequence.entropy,
+                                       spawn_key=self.seed_sequence.spawn_key + (int.from_bytes(digest[:8], "little"),))
+        return np.random.default_rng(child)
+
+    def pcm_tone(self, freq, max_amplitude, num_harmonics, tone_duration, harmonic_factor, dbspl):
+        """
+        Make a single ramped sound at the device rate quantized to pcm_bits, reusing it from the PCM cache if possible.
+
+        Same parameters as sound_maker (tone_duration in seconds).
+        Every newly quantized tone is added to pcm_report; clipping raises a warning.
+
+        :return: pcm: a read-only integer array of audio samples (if cached).
+        """
+        spec = self._tone_spec(freq, max_amplitude, num_harmonics, tone_duration, harmonic_factor, dbspl)
+        key = (spec, self.output_rate, self.pcm_bits)
+
+        pcm = self.pcm_bank.get(key)
+        if pcm is None:
+            sound = self.device_tone(freq, max_amplitude, num_harmonics, tone_duration, harmonic_factor, dbspl)
+            pcm, report = quantize_pcm(sound, self.pcm_bits, rng=self._dither_rng(spec))
+            pcm = self.pcm_bank.put(key, pcm)
+
+            self.pcm_report["tones"] += 1
+            self.pcm_report["clipped"] += report["clipped"]
+            self.pcm_report["peak"] = max(self.pcm_report["peak"], report["peak"])
+            if report["clipped"]:
+                warnings.warn(
+                    f"{report['clipped']} samples of the {freq} Hz tone clipped "
+                    f"when quantized to {self.pcm_bits} bit (peak {report['peak']:.3f}).",
+                    UserWarning
+                    )
+
+        return pcm
+
+    def output_tone(self, freq, max_amplitude, num_harmonics, tone_duration, harmonic_factor, dbspl):
+        """ Return the tone as it is played: float (device_tone) or integer PCM (pcm_tone). """
+        if self.pcm_bits:
+            return self.pcm_tone(freq, max_amplitude, num_harmonics, tone_duration, harmonic_factor, dbspl)
+        return self.device_tone(freq, max_amplitude, num_harmonics, tone_duration, harmonic_factor, dbspl)
+
+    @property
+    def output_dtype(self):
+        """ dtype of the arrays yielded by generate_soundtrack. """
+        if self.pcm_bits:
+            return np.dtype(np.int16 if self.pcm_bits == 16 else np.int32)
+        return self.dtype
+
+    def _sync_markers(self):
+        """
+        Return the markers of the sync channel at the device rate in the output dtype:
+        (tone: one pulse, trial: SYNC_TRIAL_PULSES pulses separated by gaps of one pulse).
+        """
+        pulse = max(int(self.SYNC_PULSE / 1000 * self.output_rate), 1)
+        if self.pcm_bits:
+            level, _ = quantize_pcm(np.array([self.SYNC_LEVEL]), self.pcm_bits, dither=False)
+            level = level[0]
+        else:
+            level = self.SYNC_LEVEL
+
+        tone = np.full(pulse, level, dtype=self.output_dtype)
+        trial = np.zeros((2 * self.SYNC_TRIAL_PULSES - 1) * pulse, dtype=self.output_dtype)
+        for idx in range(self.SYNC_TRIAL_PULSES):
+            trial[2 * idx * pulse:(2 * idx + 1) * pulse] = level
+
+        tone.flags.writeable = False
+        trial.flags.writeable = False
+        return tone, trial
+
+    def _allocate(self, n_samples):
+        """ Silent output buffer: samples, or samples x 2 with the sync channel. """
+        shape = (n_samples, 2) if self.sync else n_samples
+        return np.zeros(shape, dtype=self.output_dtype)
+
+    def _warn_units(self, df, tone_duration):
+        """ Remind the user that ISI, ITI and DEV are assumed to be in msec. """
         sample_isi = df["isi"].iloc[0] if not df.empty else "N/A"
         sample_iti = df["iti"].iloc[0] if not df.empty else "N/A"
         sample_dev = df["dev"].iloc[0] if not df.empty else "N/A"
@@ -120,210 +857,1011 @@ class SoundGen:
             )
         warnings.warn(message, UserWarning)
 
-        # Convert to sec (only once)
-        tone_duration = tone_duration / 1000
+    def _to_samples(self, seconds):
+        """
+        Convert a time in seconds to samples at the device rate: truncated to whole
+        samples, or as a float for fractional onsets.
+        """
+        if self.fractional:
+            return seconds * self.output_rate
+        return int(seconds * self.output_rate)
 
-        # Loop through all trials in the dataframe
-        # Each trial is a linear combination of parameters
-        for trial in df.itertuples():
+    def _tone_source(self, atlas, tone_params):
+        """
+        Return get_tone(freq): tones come from the stimulus atlas if it holds them,
+        otherwise from the tone cache (output_tone).
+        """
+        def get_tone(freq):
+            if atlas is not None and freq in atlas:
+                return atlas.view(freq)
+            return self.output_tone(freq, *tone_params)
 
-            # Initialize the sequence, log and count of frequency devs.
-            sequence = []
-            sequence_log = str()
-            freq_dev_count = 0
+        return get_tone
 
-            # Raise error if timing and frequency devs occur on the same tone
-            if not np.isnan(trial.dev_loc): # nan for silent trials
-                if trial.dev_loc in trial.freq_loc:
-                    raise ValueError(
-                        f"\nFor trial-{trial.trial_no:02d} block-{trial.block_no:02d}."
-                        " Frequency and timing deviations "
-                        f"occur on the same tone (idx: {trial.dev_loc})."
-                        "\nCheck your input dataframe."
-                        " Parameter combinations may be set incorrectly."
-                        )
-
-            # Convert isi & iti to sec on every trial
-            isi = trial.isi / 1000
-            iti = trial.iti / 1000
-                        
-            # Calculate how many isi & iti events/samples occur per event
-            iti_samples  = int(iti * self.sample_rate)
-            isi_samples  = int(isi * self.sample_rate)
-            tone_samples = int(tone_duration * self.sample_rate)
-
-            # For sound trials: convert dev to sec & get no. of samples
-            if not pd.isna(trial.dev_loc):
-                dev = trial.dev_abs / 1000
-                dev_samples = int(dev * self.sample_rate)
-
-            # Loop through each tone in the sequence
-            for i in range(trial.no_tones):
-
-                # Correct for zero indexing
-                tone_count = i + 1
-
-                # Initialize for logging
-                fDev, fDevLoc = None, None
-
-                # ----------------- Adding TONES ------------------
-                ### SILENT trials
-                # If the current trial is silent, "dev" is None.
-                if pd.isna(trial.dev):
-                    sound = np.zeros(tone_samples)
-
-                ### SOUND trials
-                # If the current trial has no frequency deviations,
-                # the first (and only) element of "freq_dev" is False.
-                elif trial.freq_dev[0]:
-
-                    # Generate frequency deviant tone at given locations
-                    if trial.freq_dev_no != 0:
-                        freq_loc = sorted(trial.freq_loc)
-                        if freq_dev_count < trial.freq_dev_no:
-                            freq_loc = freq_loc[freq_dev_count]
-                            fDevLoc  = freq_loc
-                        else:
-                            freq_loc = False
-
-                    if tone_count == freq_loc:
-                        sound = self.sound_maker(
-                            trial.freq_dev[freq_dev_count],
-                            max_amplitude,
-                            num_harmonics,
-                            tone_duration,
-                            harmonic_factor,
-                            dbspl
-                            )
-                        fDev = trial.freq_dev[freq_dev_count]
-                        
-                        # Update frequency dev count
-                        freq_dev_count += 1
-
-                    # Generate frequency standard tone at other locations
-                    else:
-                        sound = self.sound_maker(
-                        trial.base_freq,
-                        max_amplitude,
-                        num_harmonics,
-                        tone_duration,
-                        harmonic_factor,
-                        dbspl
-                        )
-
-                # Generate frequency standard tone sequence
-                else:
-                    sound = self.sound_maker(
-                        trial.base_freq,
-                        max_amplitude,
-                        num_harmonics,
-                        tone_duration,
-                        harmonic_factor,
-                        dbspl
-                        )
-
-                # Apply ramp to start and end using the sine_ramp method
-                # for sound trials only
-                if pd.isna(trial.dev_loc):
-                    ramped_sound = np.zeros(tone_samples)
-                else:
-                    ramped_sound = self.sine_ramp(sound)
-                
-                # Get tone onset and add to log
-                onset_sec = current_time / self.sample_rate
-
-                if not pd.isna(trial.dev):
-                    if trial.dev > 0:
-                        if not fDev:
-                            if tone_count == trial.dev_loc:
-                                tone_type = f"fStd-{int(trial.base_freq)}Hz_delta-p{int(trial.dev_abs)}ms_tDevLoc-{int(trial.dev_loc)}_type-fStdtDev"
-                            else:
-                                tone_type = f"fStd-{int(trial.base_freq)}Hz_type-fStdtStd"
-                        else:
-                            if tone_count == trial.dev_loc:
-                                tone_type = f"fStd-{int(trial.base_freq)}Hz_fDev-{fDev}Hz_fDevLoc-{int(fDevLoc)}_delta-p{int(trial.dev_abs)}ms_tDevLoc-{int(trial.dev_loc)}_type-fDevtDev"
-                            else:
-                                tone_type = f"fStd-{int(trial.base_freq)}Hz_fDev-{fDev}Hz_fDevLoc-{int(fDevLoc)}_type-fDevtStd"
-                    elif trial.dev < 0:
-                        if not fDev:
-                            if tone_count == trial.dev_loc:
-                                tone_type = f"fStd-{int(trial.base_freq)}Hz_delta-n{int(trial.dev_abs)}ms_tDevLoc-{int(trial.dev_loc)}_type-fStdtDev"
-                            else:
-                                tone_type = f"fStd-{int(trial.base_freq)}Hz_type-fStdtStd"
-                        else:
-                            if tone_count == trial.dev_loc:
-                                tone_type = f"fStd-{int(trial.base_freq)}Hz_fDev-{fDev}Hz_fDevLoc-{int(fDevLoc)}_delta-n{int(trial.dev_abs)}ms_tDevLoc-{int(trial.dev_loc)}_type-fDevtDev"
-                            else:
-                                tone_type = f"fStd-{int(trial.base_freq)}Hz_fDev-{fDev}Hz_fDevLoc-{int(fDevLoc)}_type-fDevtStd"
-                    else:
-                        if not fDev:
-                            tone_type = f"fStd-{int(trial.base_freq)}Hz_type-fStdtStd"
-                        else:
-                            tone_type = f"fStd-{int(trial.base_freq)}Hz_fDev-{fDev}Hz_fDevLoc-{int(fDevLoc)}_type-fDevtStd"
-                else:
-                    tone_type = "silence"
-
-                log_format = f"{onset_sec}\t{tone_duration}\t{tone_type}\n"
-                sequence_log = sequence_log + log_format
-                
-                # Add the sound to the sequence
-                sequence.append(ramped_sound)
-                current_time += tone_samples
-
-                # ----------------- Adding ISI --------------------
-                current_isi = isi_samples
-
-                # For sound trials with deviations
-                if not pd.isna(trial.dev_type):
-
-                    # Late tones
-                    # The ISI before the current tone is longer, ISI after shorter.
-                    # "dev_samples" are calculated from absolute timing deviant value
-                    if trial.dev_type == "late":
-                        if tone_count == (trial.dev_loc - 1):
-                            current_isi = isi_samples + dev_samples
-                        elif tone_count == trial.dev_loc:
-                            current_isi = isi_samples - dev_samples
-
-                    # Early tones
-                    # The ISI before the current tone is shorter, ISI after longer.
-                    elif trial.dev_type == "early":
-                        if tone_count == (trial.dev_loc - 1):
-                            current_isi = isi_samples - dev_samples
-                        elif tone_count == trial.dev_loc:
-                            current_isi = isi_samples + dev_samples
-                    
-                    # On-time tones
-                    else:
-                        current_isi = isi_samples
-
-                # Add the ISI
-                # Note: there's one less isi in the sequence than tones.
-                if tone_count < trial.no_tones:
-                    sequence.append(np.zeros(current_isi))
-                    current_time += current_isi
-
-            # -------------- Join all segments ----------------
-            final_sequence = np.concatenate(sequence)
-
-            # Check that frequency deviants were counted correctly.
-            if not pd.isna(trial.freq_dev_no):
-                if trial.freq_dev_no != freq_dev_count:
-                    raise ValueError(
-                        f"Counted more/less frequency deviants ({freq_dev_count}) "
-                        f"than specified ({trial.freq_dev_no}) "
-                        f"for trial {trial.trial_no} in block {trial.block_no}.")
+    def generate_soundtrack(self, df, current_time, max_amplitude, num_harmonics, tone_duration, harmonic_factor, dbspl,
+                            atlas=None, block_cache=None, lazy=False):
+        """
+        Generate tone sequences with timing deviants for current trial.
+        All sample counts are at the device rate (output_rate).
+
+        :param df: A dataframe with tone sequence parameters with msec as the time unit.
+        :param current_time: Current time in the experiment in sec, relative to start of the task.
+        :param max_amplitude: Maximum amplitude to avoid clipping.
+        :param num_harmonics: Number of harmonic tones.
+        :param tone_duration: Duration of the tone in milliseconds.
+        :param harmonic_factor: Harmonic amplitude decay factor for the tone.
+        :param dbspl: Desired dB SPL (loudness) level (cannot change post sound creation).
+        :param atlas: Optional StimulusAtlas with the tones of the session; tones are copied from its views.
+            A ValueError is raised if it was made with other tone parameters (see StimulusAtlas.check).
+        :param block_cache: Optional BlockCache; the block is memory-mapped from it if it was rendered before.
+        :param lazy: Render trials one at a time until the whole block, rendered in the background,
+            is ready, and time them (see _guarded_soundtrack). The render budget is checked by
+            the consumer (see Prefetcher).
+
+        :yield: final_sequence: An array of audio samples, representing harmonic a complex tone sequence
+            (a view into the block rendered by render_block; samples x 2 with the sync channel).
+        """
+        if lazy:
+            yield from self._guarded_soundtrack(
+                df, current_time, max_amplitude, num_harmonics, tone_duration, harmonic_factor, dbspl,
+                atlas, block_cache
+                )
+            return
+
+        # Render all trials at once; the trials are views into the block
+        block, timeline, _ = self.render_block(
+            df, current_time, max_amplitude, num_harmonics, tone_duration, harmonic_factor, dbspl, atlas, block_cache
+            )
+        positions = self._positions(timeline)
+
+        # Log lines of all tones (labels are not built in the trial loop)
+        lines = self.timeline_log(df, timeline, tone_duration)
+
+        # Loop through all trials in the dataframe
+        # Each trial is a linear combination of parameters
+        for trial, first, last in zip(df.itertuples(), *self._trial_bounds(df)):
+            trial_start = self._trial_start(positions, first)
+            trial_samples = int(round(timeline["offset"][last] - timeline["onset"][first]))
+            final_sequence = block[trial_start:trial_start + trial_samples]
+            sequence_log = "".join(lines[first:last + 1])
 
             # Yield the tone sequence, ITI (an array of zeros),
             # the number of frequency deviants, and the sequence log.
-            end_time = current_time / self.sample_rate
+            end_time = timeline["offset"][last] / self.output_rate
             yield final_sequence, trial.iti, trial.freq_dev_no, sequence_log, end_time
 
-            # Clear the list for the next iteration (memory <3)
-            sequence.clear()
+    def _guarded_soundtrack(self, df, current_time, max_amplitude, num_harmonics, tone_duration, harmonic_factor, dbspl,
+                            atlas, block_cache):
+        """
+        generate_soundtrack that does not wait for the whole block.
+
+        A block that is already in the block cache is used from the start. Otherwise
+        render_block starts in a background thread at the start of the block (and saves
+        the block to the block cache), and trials are rendered one at a time until it is
+        ready; the rest of the block is then sliced from it. Both give the same audio.
+
+        The synthesis (tones), render (copy into the sequence) and log stages of every
+        trial are timed, and every trial adds a dictionary to budget_report (times in seconds).
+        """
+        self._warn_units(df, tone_duration)
+        if atlas is not None:
+            atlas.check(self, (max_amplitude, num_harmonics, tone_duration, harmonic_factor, dbspl))
+        timeline, freqs = self.compile_timeline(df, current_time, tone_duration)
+        lines = self.timeline_log(df, timeline, tone_duration)
+        positions = self._positions(timeline)
+
+        tone_params = (max_amplitude, num_harmonics, tone_duration, harmonic_factor, dbspl)
+        get_tone = self._tone_source(atlas, (max_amplitude, num_harmonics, tone_duration / 1000, harmonic_factor, dbspl))
+
+        # Pre-rendered block: from the cache, or later from the background thread
+        block, pending = None, None
+        if block_cache is not None:
+            block = block_cache.load(block_cache.key(self, df, current_time, tone_params))
+
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            if block is None:
+                pending = pool.submit(
+                    self.render_block, df, current_time, *tone_params, atlas=atlas, block_cache=block_cache
+                    )
+
+            for trial, first, last in zip(df.itertuples(), *self._trial_bounds(df)):
+                start = time.perf_counter()
+                trial_samples = int(round(timeline["offset"][last] - timeline["onset"][first]))
+
+                # Switch to the pre-rendered block once it is ready
+                if pending is not None and pending.done():
+                    block, pending = pending.result()[0], None
+
+                if block is not None:
+                    synthesized = time.perf_counter()
+                    trial_start = self._trial_start(positions, first)
+                    final_sequence = block[trial_start:trial_start + trial_samples]
+                else:
+                    tones = [get_tone(freq) for freq in freqs] # cached after the first trial
+                    synthesized = time.perf_counter()
+                    final_sequence = self._allocate(trial_samples)
+                    self._place_tones(final_sequence, timeline[first:last + 1], tones,
+                                      positions[first:last + 1] - self._trial_start(positions, first))
+                rendered = time.perf_counter()
+
+                sequence_log = "".join(lines[first:last + 1])
+                done = time.perf_counter()
+
+                self.budget_report.append({
+                    "block": trial.block_no,
+                    "trial": trial.trial_no,
+                    "synthesis": synthesized - start,
+                    "render": rendered - synthesized,
+                    "log": done - rendered,
+                    "total": done - start,
+                    "prerendered": block is not None,
+                    })
+
+                end_time = timeline["offset"][last] / self.output_rate
+                yield final_sequence, trial.iti, trial.freq_dev_no, sequence_log, end_time
+
+    def _trial_bounds(self, df):
+        """ Index of the first and last tone of every trial in the timeline. """
+        no_tones = df["no_tones"].to_numpy()
+        first = np.cumsum(no_tones) - no_tones
+        return first, first + no_tones - 1
+
+    def _positions(self, timeline):
+        """
+        Position of every tone of the timeline relative to the first one (whole samples,
+        or float for fractional onsets).
+
+        Every trial starts at a whole sample (the one at or before the onset of its first tone)
+        and its tones keep their offsets from the first tone, so the first tone of a trial is
+        at exactly 0 in its slice of the block, as in a trial rendered on its own.
+        """
+        onsets = timeline["onset"]
+        if not len(onsets):
+            return np.zeros(0)
+
+        first = np.maximum.accumulate(np.where(timeline["tone"] == 1, np.arange(len(onsets)), 0))
+        positions = np.floor(onsets[first] - onsets[0]) + (onsets - onsets[first])
+        if self.fractional:
+            return positions
+        return np.rint(positions).astype(np.int64)
+
+    def _trial_start(self, positions, first):
+        """
+        Sample of the block at which the trial whose first tone is row first starts (see _positions).
+        """
+        return int(np.floor(positions[first]))
+
+    def _place_tones(self, buffer, timeline, tones, positions=None):
+        """
+        Copy the tones of the timeline rows into buffer.
+        With the sync channel, the markers are written in the same pass (at the nearest
+        sample for fractional onsets).
+
+        :param tones: One tone per session frequency (indexed by freq_idx).
+        :param positions: Position of every row in buffer (default: buffer starts at the onset of the first row).
+        """
+        audio = buffer[:, 0] if self.sync else buffer
+        if positions is None:
+            positions = self._positions(timeline)
+        sounding = ~timeline["muted"]
+        for position, freq_idx in zip(positions[sounding], timeline["freq_idx"][sounding]):
+            tone = tones[freq_idx]
+            if self.fractional:
+                self.delays.place(audio, tone, position)
+            else:
+                audio[position:position + len(tone)] = tone
+
+        if self.sync:
+            # The train at a trial start also marks its first tone
+            tone_marker, trial_marker = self.sync_markers
+            starts = timeline["tone"] == 1
+            # Nearest sample, halves rounded up (np.rint rounds them to even, which depends on the trial start)
+            for position, start, sound in zip(np.floor(positions + 0.5).astype(np.int64), starts, sounding):
+                if not (start or sound):
+                    continue
+                marker = trial_marker if start else tone_marker
+                stop = min(position + len(marker), len(buffer))
+                buffer[position:stop, 1] = marker[:stop - position]
+
+        return buffer
+
+    def render_block(self, df, current_time, max_amplitude, num_harmonics, tone_duration, harmonic_factor, dbspl,
+                     atlas=None, block_cache=None):
+        """
+        Render all trials of df (e.g. one block) into one contiguous buffer.
+
+        The buffer is allocated once (silence everywhere) with room for every tone,
+        ISI and ITI of the block, and each tone is copied into place from the tone
+        cache (or atlas), following the timeline of compile_timeline. Silent trials,
+        ISIs and ITIs are not written at all.
+
+        Same parameters as generate_soundtrack. With a BlockCache, a block rendered
+        before with the same trials and parameters is memory-mapped from disk instead,
+        and a new block is saved to it.
+
+        :return: block: the audio from the first tone onset to the end of the ITI after the last trial
+                 (samples x 2 with the sync channel),
+                 timeline, freqs: as returned by compile_timeline (onsets relative to the task start).
+        """
+        # Reminder to yourself that we're assuming msec as unit for ISI, ITI, and DEV
+        self._warn_units(df, tone_duration)
+        if atlas is not None:
+            atlas.check(self, (max_amplitude, num_harmonics, tone_duration, harmonic_factor, dbspl))
+
+        timeline, freqs = self.compile_timeline(df, current_time, tone_duration)
+
+        # Reuse the block from the disk cache
+        if block_cache is not None:
+            key = block_cache.key(self, df, current_time, (max_amplitude, num_harmonics, tone_duration, harmonic_factor, dbspl))
+            block = block_cache.load(key)
+            if block is not None:
+                return block, timeline, freqs
+
+        # Convert to sec (only once)
+        tone_duration = tone_duration / 1000
+        get_tone = self._tone_source(atlas, (max_amplitude, num_harmonics, tone_duration, harmonic_factor, dbspl))
+        tones = [get_tone(freq) for freq in freqs]
+
+        if not len(timeline):
+            return self._allocate(0), timeline, freqs
+
+        # Preallocate the block: up to the end of the last trial and its ITI
+        end = timeline["offset"][-1] - timeline["onset"][0] + self._to_samples(df["iti"].iloc[-1] / 1000)
+        block = self._allocate(int(round(end)))
+
+        # Copy every tone into place
+        self._place_tones(block, timeline, tones)
+
+        if block_cache is not None:
+            block = block_cache.save(key, block)
 
-            # Add the iti to current time
-            current_time += iti_samples
+        return block, timeline, freqs
+
+    def render_session(self, df, current_time, max_amplitude, num_harmonics, tone_duration, harmonic_factor, dbspl,
+                       atlas=None, workers=None):
+        """
+        Render all trials of df at once with a thread pool (NumPy releases the GIL
+        in the array copies and synthesis).
+
+        Same parameters as generate_soundtrack. The onsets, logs and end times come
+        from the timeline (compile_timeline), so they are identical to those of
+        generate_soundtrack; only the audio of the trials is rendered concurrently.
+        The tones of the session are synthesized once before the threads start.
+
+        :param workers: Number of threads (None: ThreadPoolExecutor default).
+
+        :return: results: a list with one (final_sequence, iti, freq_dev_no, sequence_log, end_time)
+            tuple per trial, in trial order (as yielded by generate_soundtrack).
+        """
+        # Reminder to yourself that we're assuming msec as unit for ISI, ITI, and DEV
+        self._warn_units(df, tone_duration)
+        if atlas is not None:
+            atlas.check(self, (max_amplitude, num_harmonics, tone_duration, harmonic_factor, dbspl))
+
+        timeline, freqs = self.compile_timeline(df, current_time, tone_duration)
+        lines = self.timeline_log(df, timeline, tone_duration)
+
+        # Synthesize every tone of the session before rendering
+        tone_duration = tone_duration / 1000
+        get_tone = self._tone_source(atlas, (max_amplitude, num_harmonics, tone_duration, harmonic_factor, dbspl))
+        tones = [get_tone(freq) for freq in freqs]
+
+        # Render the audio of all trials concurrently (tones at the same positions as in render_block)
+        positions = self._positions(timeline)
+
+        def render(first, last):
+            trial_samples = int(round(timeline["offset"][last] - timeline["onset"][first]))
+            sequence = self._allocate(trial_samples)
+            trial_positions = positions[first:last + 1] - self._trial_start(positions, first)
+            return self._place_tones(sequence, timeline[first:last + 1], tones, trial_positions)
+
+        firsts, lasts = self._trial_bounds(df)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            sequences = list(pool.map(render, firsts, lasts))
+
+        return [
+            (sequence, trial.iti, trial.freq_dev_no, "".join(lines[first:last + 1]), timeline["offset"][last] / self.output_rate)
+            for sequence, trial, first, last in zip(sequences, df.itertuples(), firsts, lasts)
+            ]
+
+    def compile_timeline(self, df, current_time, tone_duration):
+        """
+        Compile the trial dataframe into a structured array with one row per tone
+        (see TIMELINE_DTYPE), without rendering any audio.
+
+        The onsets are cumulative sums of the tone durations, ISIs and ITIs, added
+        one after the other in trial order (start, tone, gap, tone, gap, ...).
+
+        :param df: A dataframe with tone sequence parameters with msec as the time unit.
+        :param current_time: Time of the first tone in msec.
+        :param tone_duration: Duration of the tone in milliseconds.
+
+        :return: timeline: structured array with one row per tone,
+                 freqs: the session frequencies that freq_idx refers to.
+        """
+        freqs = np.array(session_frequencies(df))
+        rate = self.output_rate
+
+        # Trial parameters, repeated for every tone of the trial
+        no_tones = df["no_tones"].to_numpy()
+        rows = np.repeat(np.arange(len(df)), no_tones)
+        first, _ = self._trial_bounds(df)
+        tone = np.arange(len(rows)) - first[rows] + 1
+        last = tone == no_tones[rows]
+
+        dev = df["dev"].to_numpy(dtype=float)[rows]
+        dev_loc = df["dev_loc"].to_numpy(dtype=float)[rows]
+        dev_type = df["dev_type"].to_numpy(dtype=object)[rows]
+        late, early = dev_type == "late", dev_type == "early"
+        silent = np.isnan(dev)
+
+        # Samples per event (truncated to whole samples, as _to_samples)
+        def to_samples(msec):
+            samples = np.nan_to_num(np.asarray(msec, dtype=float)) / 1000 * rate
+            return samples if self.fractional else np.trunc(samples)
+
+        tone_samples = int(tone_duration / 1000 * rate)
+        isi = to_samples(df["isi"])[rows]
+        iti = to_samples(df["iti"])[rows]
+        dev_samples = to_samples(df["dev_abs"])[rows]
+
+        # Gap after each tone: ISI, or the ITI after the last tone.
+        # Late tones: the ISI before the tone is longer, the ISI after shorter.
+        # Early tones: the ISI before the tone is shorter, the ISI after longer.
+        before = (tone == dev_loc - 1) & ~last
+        after = (tone == dev_loc) & ~last
+        gap = np.where(last, iti, isi)
+        gap = np.where((late & before) | (early & after), gap + dev_samples, gap)
+        gap = np.where((late & after) | (early & before), gap - dev_samples, gap)
+
+        # Onsets: start, tone, gap, tone, gap, ... summed one after the other
+        steps = np.empty(2 * len(rows) + 1)
+        steps[0] = current_time / 1000 * rate
+        steps[1::2] = tone_samples
+        steps[2::2] = gap
+        times = np.cumsum(steps)
+
+        # Frequency of each tone: base frequency, frequency deviants at their (sorted) locations
+        tone_freq = df["base_freq"].to_numpy(dtype=float)[rows]
+        f_dev = np.zeros(len(rows), dtype=bool)
+        for row, trial in enumerate(df.itertuples()):
+            if pd.isna(trial.dev) or not trial.freq_dev[0]:
+                continue
+
+            # Raise error if timing and frequency devs occur on the same tone
+            if trial.dev_loc in trial.freq_loc:
+                raise ValueError(
+                    f"\nFor trial-{trial.trial_no:02d} block-{trial.block_no:02d}."
+                    " Frequency and timing deviations "
+                    f"occur on the same tone (idx: {trial.dev_loc})."
+                    "\nCheck your input dataframe."
+                    " Parameter combinations may be set incorrectly."
+                    )
+            locs = [loc for loc in sorted(trial.freq_loc)[:int(trial.freq_dev_no)] if 1 <= loc <= trial.no_tones]
+            idx = first[row] + np.array(locs, dtype=int) - 1
+            tone_freq[idx] = trial.freq_dev[:len(locs)]
+            f_dev[idx] = True
+
+        # Check that frequency deviants were counted correctly.
+        freq_dev_no = df["freq_dev_no"].to_numpy(dtype=float)
+        freq_dev_count = np.bincount(rows, weights=f_dev, minlength=len(df))
+        wrong = ~np.isnan(freq_dev_no) & (freq_dev_no != freq_dev_count)
+        if wrong.any():
+            trial = df.iloc[np.argmax(wrong)]
+            raise ValueError(
+                f"Counted more/less frequency deviants ({int(freq_dev_count[np.argmax(wrong)])}) "
+                f"than specified ({trial.freq_dev_no}) "
+                f"for trial {trial.trial_no} in block {trial.block_no}.")
+
+        timeline = np.zeros(len(rows), dtype=TIMELINE_DTYPE)
+        timeline["block"] = df["block_no"].to_numpy()[rows]
+        timeline["trial"] = df["trial_no"].to_numpy()[rows]
+        timeline["tone"] = tone
+        timeline["onset"] = times[0:-1:2]
+        timeline["offset"] = times[1::2]
+        timeline["freq_idx"] = np.where(silent, -1, np.searchsorted(freqs, np.nan_to_num(tone_freq)))
+        timeline["t_dev"] = (late | early) & (tone == dev_loc)
+        timeline["f_dev"] = f_dev
+        timeline["silent"] = silent
+
+        # Only trials with a dev_loc are rendered: on-time trials (dev == 0) are silent
+        # too, although the log labels their tones as standards
+        timeline["muted"] = np.isnan(dev_loc)
+
+        return timeline, freqs
+
+    def timeline_log(self, df, timeline, tone_duration):
+        """
+        Log line of every tone of the timeline: onset and duration in sec and tone_type, tab-separated.
+
+        All tone_type labels are built at once with pandas string operations
+        from the timeline and the trial columns (no formatting per tone), e.g.
+            fStd-440Hz_type-fStdtStd
+            fStd-440Hz_delta-p13ms_tDevLoc-5_type-fStdtDev
+            fStd-392Hz_fDev-440Hz_fDevLoc-3_type-fDevtStd
+            silence
+
+        :param df: The dataframe the timeline was compiled from.
+        :param timeline: Output of compile_timeline.
+        :param tone_duration: Duration of the tone in milliseconds.
+
+        :return: lines: an object array with one log line per tone; join them with "".join.
+        """
+        rows = np.repeat(np.arange(len(df)), df["no_tones"].to_numpy())
+
+        def column(name):
+            """ Trial column as text (whole numbers), repeated for every tone. """
+            return pd.Series(df[name].fillna(0).astype(int).astype(str).to_numpy()[rows])
+
+        # Frequency deviants are written as in the freq_dev lists of the dataframe (e.g. 440, not 440.0)
+        freqs = np.array(session_frequencies(df))
+        freq_text = {float(f): str(f) for freq_dev in df["freq_dev"] if isinstance(freq_dev, list) for f in freq_dev if f}
+        fdev = pd.Series(freqs[np.maximum(timeline["freq_idx"], 0)] if len(freqs) else np.zeros(len(timeline)))
+        fdev = fdev.map(freq_text).fillna("")
+
+        f_dev = pd.Series(timeline["f_dev"])
+        t_dev = pd.Series(timeline["t_dev"])
+        sign = pd.Series(np.where(df["dev"].to_numpy(dtype=float)[rows] > 0, "p", "n"))
+        tone = pd.Series(timeline["tone"].astype(str))
+
+        label = "fStd-" + column("base_freq") + "Hz"
+        label = label.where(~f_dev, label + "_fDev-" + fdev + "Hz_fDevLoc-" + tone)
+        label = label.where(~t_dev, label + "_delta-" + sign + column("dev_abs") + "ms_tDevLoc-" + column("dev_loc"))
+        label = label + "_type-" + np.where(f_dev, "fDev", "fStd") + np.where(t_dev, "tDev", "tStd")
+        label = label.where(~pd.Series(timeline["silent"]), "silence")
+
+        onset = pd.Series((timeline["onset"] / self.output_rate).tolist()).astype(str)
+        lines = onset + f"\t{tone_duration / 1000}\t" + label + "\n"
+
+        return lines.to_numpy(dtype=object)
+
+def session_frequencies(df):
+    """
+    Return the sorted unique tone frequencies (standards and frequency deviants)
+    of the sound trials in a dataframe of trial parameters.
+    """
+    sound_trials = df[df["dev"].notna()]
+    freqs = set(sound_trials["base_freq"].astype(float))
+    for freq_dev in sound_trials["freq_dev"]:
+        freqs.update(float(f) for f in freq_dev if f) # [False] if there are no deviants
+
+    return sorted(freqs)
+
+class StimulusAtlas:
+    def __init__(self, buffer, index, info=None):
+        """
+        All unique tones of a session in one contiguous array.
+
+        :param buffer: 1D array with all tones one after the other.
+        :param index: Dictionary {frequency in Hz: (offset, length)} in samples.
+        :param info: Dictionary with the tone parameters and SoundGen settings the atlas was made with (see describe).
+        """
+        self.buffer = buffer
+        self.index = index
+        self.info = info or {}
+
+    @classmethod
+    def from_session(cls, sound_gen, df, max_amplitude, num_harmonics, tone_duration, harmonic_factor, dbspl):
+        """
+        Make the atlas of all tones needed by the trials in df, as played by sound_gen
+        (device rate, dtype and PCM settings of sound_gen).
+
+        :param tone_duration: Duration of the tone in milliseconds (as in generate_soundtrack).
+        """
+        info = cls.describe(sound_gen, (max_amplitude, num_harmonics, tone_duration, harmonic_factor, dbspl))
+        tone_params = (max_amplitude, num_harmonics, tone_duration / 1000, harmonic_factor, dbspl)
+        tones = {freq: sound_gen.output_tone(freq, *tone_params) for freq in session_frequencies(df)}
+
+        # Copy the tones into one buffer
+        buffer = np.empty(sum(len(tone) for tone in tones.values()), dtype=sound_gen.output_dtype)
+        index = {}
+        offset = 0
+        for freq, tone in tones.items():
+            buffer[offset:offset + len(tone)] = tone
+            index[freq] = (offset, len(tone))
+            offset += len(tone)
+
+        return cls(buffer, index, info)
+
+    @staticmethod
+    def describe(sound_gen, tone_params):
+        """
+        Return the info of an atlas of tones played by sound_gen with the given tone parameters:
+        the tone parameters and every SoundGen setting that changes a tone (as in BlockCache.key).
+
+        :param tone_params: (max_amplitude, num_harmonics, tone_duration, harmonic_factor, dbspl),
+            tone_duration in milliseconds.
+        """
+        max_amplitude, num_harmonics, tone_duration, harmonic_factor, dbspl = tone_params
+        return {
+            "max_amplitude": max_amplitude,
+            "num_harmonics": num_harmonics,
+            "tone_duration": tone_duration,
+            "harmonic_factor": harmonic_factor,
+            "dbspl": dbspl,
+            "sample_rate": sound_gen.sample_rate,
+            "tau": sound_gen.tau,
+            "kernel": sound_gen.kernel,
+            "fft_tolerance": sound_gen.fft_tolerance,
+            "tile": sound_gen.tile,
+            "rms": sound_gen.rms,
+            "ramp_shape": sound_gen.ramp_shape,
+            "output_rate": sound_gen.output_rate,
+            "dtype": str(sound_gen.output_dtype),
+            "pcm_bits": sound_gen.pcm_bits,
+            "seed": [sound_gen.seed_sequence.entropy, list(sound_gen.seed_sequence.spawn_key)] if sound_gen.pcm_bits else None,
+            }
+
+    def check(self, sound_gen, tone_params):
+        """
+        Raise a ValueError if the atlas was made with other tone parameters or SoundGen
+        settings than requested (see describe). Parameters missing from info (e.g. in an
+        atlas saved by an older version) count as different: make the atlas again.
+
+        :param sound_gen: The SoundGen instance the tones are played with.
+        :param tone_params: (max_amplitude, num_harmonics, tone_duration, harmonic_factor, dbspl),
+            tone_duration in milliseconds.
+        """
+        requested = self.describe(sound_gen, tone_params)
+        mismatch = {key: (self.info.get(key, "missing"), value) for key, value in requested.items()
+                    if key not in self.info or self.info[key] != value}
+        if mismatch:
+            differences = ", ".join(f"{key}: {atlas} (atlas) != {value} (requested)" for key, (atlas, value) in mismatch.items())
+            raise ValueError(f"The stimulus atlas does not match the requested tones ({differences}).")
+
+    def __contains__(self, freq):
+        return float(freq) in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def view(self, freq):
+        """ Return the tone of the given frequency as a view into the buffer (no copy). """
+        offset, length = self.index[float(freq)]
+        return self.buffer[offset:offset + length]
+
+    def save(self, path):
+        """
+        Save the buffer as one .npy file and the index next to it as .json.
+        """
+        path = Path(path).with_suffix(".npy")
+        np.save(path, self.buffer)
+        with open(path.with_suffix(".json"), "w") as f:
+            json.dump({
+                "index": [[freq, offset, length] for freq, (offset, length) in self.index.items()],
+                "info": self.info,
+                }, f, indent=2)
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        """
+        Load an atlas saved with save(). By default, the buffer is memory-mapped (read-only, no copy).
+        """
+        path = Path(path).with_suffix(".npy")
+        buffer = np.load(path, mmap_mode=mmap_mode)
+        with open(path.with_suffix(".json")) as f:
+            saved = json.load(f)
+        index = {float(freq): (int(offset), int(length)) for freq, offset, length in saved["index"]}
+
+        return cls(buffer, index, saved["info"])
+
+class BlockCache:
+
+    # Increase when the rendering changes, so old cached blocks are not used anymore
+    VERSION = 6
+
+    def __init__(self, directory):
+        """
+        On-disk cache of rendered blocks (render_block), one .npy file per block.
+
+        The file name is a hash of the trial rows of the block and of every
+        SoundGen and tone parameter that changes the audio, so a changed CSV or
+        parameter gives a new file. Cached blocks are memory-mapped read-only,
+        so a rerun plays bit-identical audio without synthesis. Blocks are stored
+        whole, ITIs and silent trials included: about 140 MB for a block of 108
+        trials in float32 at 48 kHz.
+
+        :param directory: Folder for the cached blocks (created if needed).
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, sound_gen, df, current_time, tone_params):
+        """
+        Return the hash (hex string) of a block.
+
+        :param sound_gen: The SoundGen instance rendering the block.
+        :param df: Trial rows of the block.
+        :param current_time: Block start in msec (only used for fractional onsets,
+            where the sub-sample positions depend on it).
+        :param tone_params: (max_amplitude, num_harmonics, tone_duration, harmonic_factor, dbspl).
+        """
+        settings = {
+            "version": self.VERSION,
+            "sample_rate": sound_gen.sample_rate,
+            "tau": sound_gen.tau,
+            "kernel": sound_gen.kernel,
+            "fft_tolerance": sound_gen.fft_tolerance,
+            "tile": sound_gen.tile,
+            "rms": sound_gen.rms,
+            "dtype": str(sound_gen.dtype),
+            "pcm_bits": sound_gen.pcm_bits,
+            "ramp_shape": sound_gen.ramp_shape,
+            "output_rate": sound_gen.output_rate,
+            "fractional": sound_gen.fractional,
+            "sync": sound_gen.sync,
+            "start": current_time if sound_gen.fractional else None,
+            "seed": [sound_gen.seed_sequence.entropy, sound_gen.seed_sequence.spawn_key] if sound_gen.pcm_bits else None,
+            "tone_params": list(tone_params),
+            }
+        digest = hashlib.sha256(json.dumps(settings, sort_keys=True, default=str).encode())
+        digest.update(df.to_csv(index=False).encode())
+        return digest.hexdigest()
+
+    def path(self, key):
+        return self.directory / f"{key}.npy"
+
+    def load(self, key):
+        """ Return the memory-mapped block for key, or None if it is not cached. """
+        path = self.path(key)
+        if not path.exists():
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return np.load(path, mmap_mode="r")
+
+    def save(self, key, block):
+        """ Write the block (to a temporary file first, so a crash leaves no partial block) and return it memory-mapped. """
+        path = self.path(key)
+        tmp_path = path.with_suffix(".tmp.npy")
+        np.save(tmp_path, block)
+        tmp_path.replace(path)
+        return np.load(path, mmap_mode="r")
+
+def session_hash(sound_gen, df, tone_params):
+    """
+    Return the sha256 (hex string) of the audio of a session: every block rendered
+    from its own start (as prerender_sessions.py caches them), in block order.
+
+    The audio depends only on the trial rows, the SoundGen parameters, its seed (dither of
+    PCM output) and the tone parameters, so a session can be regenerated bit-exactly
+    from them and checked against a stored hash instead of storing the audio.
+
+    :param sound_gen: The SoundGen instance rendering the blocks (no block cache is used).
+    :param df: Trial rows of the session.
+    :param tone_params: (max_amplitude, num_harmonics, tone_duration, harmonic_factor, dbspl).
+    """
+    digest = hashlib.sha256()
+    for block_idx in sorted(df["block_no"].unique()):
+        block, _, _ = sound_gen.render_block(df[df["block_no"] == block_idx], 0, *tone_params)
+        digest.update(np.ascontiguousarray(block).tobytes())
+    return digest.hexdigest()
+
+class Prefetcher:
+    def __init__(self, iterable, depth=2, budget=None, trials=None):
+        """
+        Iterate over iterable while a background thread produces the next items ahead of time,
+        e.g. the next trials of generate_soundtrack while the current trial plays.
+
+        For every item, the time the consumer waited for it and the number of items
+        that were ready in the queue are recorded (see stats). Errors raised by the
+        iterable are raised again in the consumer.
+
+        With a budget, the render budget is checked where the consumer takes the items:
+        trial n+1 must be ready at most budget * ITI of trial n after trial n was taken.
+        A trial over budget raises a warning with its trial and block number and is
+        added to overruns.
+
+        :param iterable: Any iterable (e.g. the generate_soundtrack generator).
+        :param depth: Maximum number of items produced ahead of the consumer.
+        :param budget: Optional fraction of the previous trial's ITI that producing a trial may take.
+        :param trials: Dataframe with the trial_no, block_no and iti (msec) of every item (required with a budget).
+        """
+        if depth < 1:
+            raise ValueError(f"Prefetch depth must be at least 1, got {depth}.")
+        if budget is not None and trials is None:
+            raise ValueError("A render budget needs the trials dataframe of the items.")
+
+        self.depth = depth
+        self.budget = budget
+        self.trials = trials
+        self.waits = []    # seconds the consumer waited for each item
+        self.depths = []   # items ready in the queue when each item was requested
+        self.overruns = [] # trials that were not ready within their budget
+        self._taken = None # time the previous item was taken
+        self._queue = queue.Queue(maxsize=depth)
+        self._stop = threading.Event()
+        self._done = False
+        self._thread = threading.Thread(target=self._produce, args=(iterable,), daemon=True)
+        self._thread.start()
+
+    def _put(self, kind, payload):
+        """ Put an item in the queue unless the prefetcher is closed; return False if it is. """
+        ready = time.perf_counter()
+        while not self._stop.is_set():
+            try:
+                self._queue.put((kind, payload, ready), timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce(self, iterable):
+        try:
+            for item in iterable:
+                if not self._put("item", item):
+                    return
+        except Exception as error:
+            self._put("error", error)
+            return
+        self._put("done", None)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._done:
+            raise StopIteration
+
+        depth = self._queue.qsize()
+        start = time.perf_counter()
+        kind, payload, ready = self._queue.get()
+        taken = time.perf_counter()
+        wait = taken - start
+
+        if kind != "item":
+            self._done = True
+            self._stop.set()
+            if kind == "error":
+                raise payload
+            raise StopIteration
+
+        if self.budget is not None:
+            self._check_budget(ready, taken)
+
+        self.depths.append(depth)
+        self.waits.append(wait)
+        return payload
+
+    def _check_budget(self, ready, taken):
+        """ Check that the item just taken was ready within the budget of the previous one (none for the first). """
+        index = len(self.waits)
+        if index and index < len(self.trials):
+            previous, trial = self.trials.iloc[index - 1], self.trials.iloc[index]
+            limit = self.budget * previous["iti"] / 1000
+            used = max(ready - self._taken, 0.0)
+            if used > limit:
+                self.overruns.append({
+                    "block": trial["block_no"],
+                    "trial": trial["trial_no"],
+                    "used": used,
+                    "budget": limit,
+                    })
+                warnings.warn(
+                    f"Trial {trial['trial_no']} of block {trial['block_no']} was ready {used * 1000:.1f} ms into the ITI, "
+                    f"over its budget of {limit * 1000:.1f} ms ({self.budget:g} x ITI of {previous['iti']} ms).",
+                    UserWarning
+                    )
+        self._taken = taken
+
+    def close(self):
+        """ Stop the background thread (items not consumed yet are dropped). """
+        self._done = True
+        self._stop.set()
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def stats(self):
+        """
+        Return the prefetch counters as a dictionary: number of items, total, mean and max
+        wait in seconds, items that had to be waited for (none ready in the queue), and
+        the min and mean queue depth when an item was requested, and the number of render budget overruns.
+        """
+        waits = np.array(self.waits)
+        depths = np.array(self.depths)
+        return {
+            "items": len(waits),
+            "total_wait": float(waits.sum()),
+            "mean_wait": float(waits.mean()) if len(waits) else 0.0,
+            "max_wait": float(waits.max()) if len(waits) else 0.0,
+            "waited": int(np.sum(depths == 0)),
+            "min_depth": int(depths.min()) if len(depths) else 0,
+            "mean_depth": float(depths.mean()) if len(depths) else 0.0,
+            "overruns": len(self.overruns),
+            }
+
+class TrialPlayback:
+    def __init__(self, audio, start):
+        """
+        One trial scheduled on a BlockStream. The times are filled in by the stream callback.
+
+        :param audio: Samples of the trial (samples, or samples x channels).
+        :param start: Frame at which the trial is scheduled to start (see BlockStream.schedule).
+        """
+        self.audio = audio
+        self.start = start
+        self.dac_time = None     # time (stream clock, sec) the first sample reaches the DAC
+        self.end_dac_time = None # time the last sample reaches the DAC
+        self.late = 0            # frames the trial started after its scheduled start
+        self.done = threading.Event()
+
+    def wait(self, timeout=None):
+        """ Block until the last sample of the trial has been passed to the sound card (replaces sd.wait). """
+        self.done.wait(timeout)
+        return self
+
+class BlockStream:
+
+    # Frames of silence before the first trial, so the first callbacks have time to fill the buffers
+    LEAD = 0.05 # sec
+
+    def __init__(self, samplerate, channels=1, dtype="float32", device=None, latency="low", blocksize=0):
+        """
+        Play a block of trials through one persistent sounddevice.OutputStream.
+
+        Trials are scheduled at frames of the block timeline (e.g. the tone onsets of
+        compile_timeline), so ITIs are exact sample counts and not clock waits, and
+        the stream is opened once per block instead of once per trial (sd.play). The
+        callback copies the samples from the scheduled arrays, so any array works as
+        a source: a rendered block, a memory-mapped block of the BlockCache or the
+        trials of generate_soundtrack. It records the DAC time of every trial.
+
+        Use it as a context manager: the stream is started on enter and closed on exit.
+
+        :param samplerate: Sample rate of the device (SoundGen.output_rate).
+        :param channels: Number of output channels (2 with the sync channel of SoundGen).
+        :param dtype: Sample type (SoundGen.output_dtype: float32, int16 or int32).
+        :param device: Output device (None: sounddevice default).
+        :param latency: Latency of the stream ("low", "high" or seconds).
+        :param blocksize: Frames per callback (0: chosen by the host API).
+        """
+        self.samplerate = samplerate
+        self.channels = channels
+        self.dtype = np.dtype(dtype)
+        self.trials = []     # TrialPlayback of every scheduled trial
+        self.underflows = 0  # callbacks with an output underflow (reported by PortAudio)
+        self._queue = queue.Queue()
+        self._current = None
+        self._stream_frame = 0 # frames passed to the device so far
+        self._offset = None    # block timeline frame minus stream frame (set by the first schedule)
+        self._stream = sd.OutputStream(
+            samplerate=samplerate, channels=channels, dtype=self.dtype.name, device=device,
+            latency=latency, blocksize=blocksize, callback=self._callback
+            )
+
+    def schedule(self, audio, start):
+        """
+        Queue audio to start at frame start of the block timeline. Trials must be
+        scheduled in order; the frames between them are silent. The first trial starts
+        LEAD seconds after it is scheduled. A trial scheduled too late starts at once
+        and its delay is recorded (TrialPlayback.late).
+
+        :return: the TrialPlayback of the trial (wait() on it to wait for the end of the trial).
+        """
+        if self._offset is None:
+            self._offset = int(start) - int(self.LEAD * self.samplerate) - self._stream_frame
+
+        trial = TrialPlayback(audio, int(start))
+        self.trials.append(trial)
+        self._queue.put(trial)
+        return trial
+
+    def play(self, trials, start_of):
+        """
+        Schedule trials one ahead of the consumer: when a trial is yielded, the next one
+        is already queued, so it starts on time while the responses to the current one
+        are collected.
+
+        :param trials: Iterable of trials whose first element is the audio (e.g. generate_soundtrack).
+        :param start_of: Function returning the start frame of a trial.
+        :yield: (trial, playback): the trial as given and its TrialPlayback.
+        """
+        iterator = iter(trials)
+        current = next(iterator, None)
+        if current is None:
+            return
+
+        playback = self.schedule(current[0], start_of(current))
+        for upcoming in iterator:
+            upcoming_playback = self.schedule(upcoming[0], start_of(upcoming))
+            yield current, playback
+            current, playback = upcoming, upcoming_playback
+        yield current, playback
+
+    def _callback(self, outdata, frames, time_info, status):
+        """ Copy the scheduled trials into outdata; silence where no trial is scheduled. """
+        if status.output_underflow:
+            self.underflows += 1
+
+        outdata.fill(0)
+        if self._offset is None:
+            self._stream_frame += frames
+            return
+
+        first = self._stream_frame + self._offset # block timeline frame of outdata[0]
+        end = first + frames
+        pos = 0
+        while pos < frames:
+            trial = self._current
+            if trial is None:
+                try:
+                    trial = self._current = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+
+            frame = first + pos
+            if trial.dac_time is None:
+                if trial.start >= end:
+                    break
+                if trial.start > frame:
+                    pos = trial.start - first
+                    continue
+
+                # First sample of the trial (late if its start has passed)
+                trial.late = frame - trial.start
+                trial.dac_time = time_info.outputBufferDacTime + pos / self.samplerate
+
+            offset = frame - trial.start - trial.late
+            n = min(frames - pos, len(trial.audio) - offset)
+            outdata[pos:pos + n] = trial.audio[offset:offset + n].reshape(n, -1)
+            pos += n
+
+            if offset + n == len(trial.audio):
+                trial.end_dac_time = time_info.outputBufferDacTime + pos / self.samplerate
+                self._current = None
+                trial.done.set()
+
+        self._stream_frame += frames
+
+    @property
+    def time(self):
+        """ Current time of the stream clock in sec (the clock of dac_time and end_dac_time). """
+        return self._stream.time
+
+    def __enter__(self):
+        self._stream.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """ Wait until the scheduled trials have been played, then stop and close the stream. """
+        for trial in self.trials:
+            if not trial.done.wait(timeout=len(trial.audio) / self.samplerate + 1):
+                break
+        self._stream.stop()
+        self._stream.close()
+
+    def stats(self):
+        """
+        Return the timing of the played trials as a dictionary: number of trials, late
+        trials and frames, PortAudio output underflows, and the jitter (sec) of the DAC
+        onsets against the scheduled frames, relative to the first trial.
+        """
+        played = [trial for trial in self.trials if trial.dac_time is not None]
+        if played:
+            scheduled = np.array([trial.start for trial in played]) / self.samplerate
+            measured = np.array([trial.dac_time for trial in played])
+            jitter = (measured - measured[0]) - (scheduled - scheduled[0])
+        else:
+            jitter = np.zeros(0)
+        return {
+            "trials": len(played),
+            "late": sum(trial.late > 0 for trial in played),
+            "late_frames": int(sum(trial.late for trial in played)),
+            "underflows": self.underflows,
+            "max_jitter": float(np.max(np.abs(jitter))) if len(jitter) else 0.0,
+            "mean_jitter": float(np.mean(jitter)) if len(jitter) else 0.0,
+            }
 
 # TEST: example usage -----------------------------------------------------------------------------
 if __name__ == "__main__":
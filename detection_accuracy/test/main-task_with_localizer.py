@@ -12,10 +12,9 @@ Local setup: All localizer sounds must be in "Stimuli" folder. Sounds need "s3"
 
 # 00. PREPARATION ------------------------------------------------------------------------
 import ast
-import random
+import json
 import numpy as np
 import pandas as pd
-import sounddevice as sd
 from pathlib import Path
 from datetime import datetime 
 from expyriment import design, control, stimuli, misc, io
@@ -72,8 +71,15 @@ params = {
     "NUM_HARMONICS"   : 10,     # Number of harmonics
     "HARMONIC_FACTOR" : 0.8,    # Harmonic amplitude decay factor
     "MAX_AMPLITUDE"   : 1.14,   # Defined through a simulation
-    "SAMPLE_RATE"     : 48000,  # Hz
+    "SAMPLE_RATE"     : 48000,  # Hz, tones are synthesized at this rate
+    "DEVICE_RATE"     : 48000,  # Hz, change depending on the speakers (tones are resampled)
     "TAU"             : 5,      # Ramping window in msec
+    "AUDIO_DTYPE"     : "float32", # Played by sounddevice without conversion
+    "SYNC_CHANNEL"    : False,  # Second output channel with a pulse at every tone onset and a pulse train at every trial start
+    "BLOCK_CACHE_DIR" : "block_cache", # Rendered blocks, reused on reruns (in PROJECT_ROOT)
+    "PREFETCH_DEPTH"  : 2,      # Trials rendered ahead in the background
+    "RENDER_BUDGET"   : 0.25,   # Fraction of the ITI that rendering the next trial may take
+    "SEED"            : None,   # Entropy of the SeedSequence of all random draws (None: drawn from the OS and saved with the logs)
     
     # Sound stimuli in localizer
     "SOUND_STRATA"     : 84,   # the total amount of available sounds
@@ -131,9 +137,14 @@ params = {
     "END_TEXT"         : "Thank you so much for your participation!\n\n",
 }
 
+# Every random draw of the session (localizer sounds and order, dither of PCM audio) comes from one
+# SeedSequence. Its entropy is saved next to the logs of every run, so the session can be generated again from it.
+seed_seq = np.random.SeedSequence(params["SEED"])
+loc_rng  = np.random.default_rng(seed_seq.spawn(1)[0])
+
 # 2. FUNCTIONS --------------------------------------------------------------------------
 # Functions needed for the localizers.
-def create_soundtrack(sound_strata, sequence_len, rep_prob, sequence_no):
+def create_soundtrack(sound_strata, sequence_len, rep_prob, sequence_no, rng):
     '''
     Generates sounds sequences with the following constraints:
     (a) Each sound has a probability of repetition defined by rep_prob.
@@ -146,6 +157,7 @@ def create_soundtrack(sound_strata, sequence_len, rep_prob, sequence_no):
     - sequence_len: The number of sounds per sequence.
     - rep_prob: The probability of a sound repeating within the experiment.
     - sequence_no: The total number of sequences.
+    - rng: np.random.Generator of all random draws.
 
     Returns:
     - sequences: A list of lists (sound sequences) with the above constraints.
@@ -154,7 +166,7 @@ def create_soundtrack(sound_strata, sequence_len, rep_prob, sequence_no):
     # Calculate the number of unique and repeated sounds across the sequences.
     total_sounds = sequence_len * sequence_no
     n_reps_float = rep_prob * total_sounds
-    n_reps = int(np.floor(n_reps_float) + (np.random.rand() < (n_reps_float - np.floor(n_reps_float))))
+    n_reps = int(np.floor(n_reps_float) + (rng.random() < (n_reps_float - np.floor(n_reps_float))))
     n_norep_max = total_sounds - n_reps
     if n_reps > total_sounds - 5:
         raise ValueError("Probability of repetitions is too high.")
@@ -166,7 +178,7 @@ def create_soundtrack(sound_strata, sequence_len, rep_prob, sequence_no):
     # Create a list of non-repeated sounds. A repetition is when two sounds repeat consecutively.
     resample = True
     while resample:
-        all_strata_sounds = [sound_strata[u] for _ in range(n_loops) for u in np.random.permutation(len(sound_strata))]
+        all_strata_sounds = [sound_strata[u] for _ in range(n_loops) for u in rng.permutation(len(sound_strata))]
         
         # Check for sequential repetitions in the generated sequence: no previous and current sound are the same.
         resample = any([all_strata_sounds[u] == all_strata_sounds[u - 1] for u in range(1, len(all_strata_sounds))])
@@ -188,7 +200,7 @@ def create_soundtrack(sound_strata, sequence_len, rep_prob, sequence_no):
     while resample:
 
         # Randomly sample repetition indices, ensuring no overlap with unique_idx.
-        repeat_idx = [(idx, idx + 1) for idx in np.sort(np.random.permutation(range(3, total_sounds - 1))[:n_reps])]
+        repeat_idx = [(idx, idx + 1) for idx in np.sort(rng.permutation(range(3, total_sounds - 1))[:n_reps])]
         flattened_repeat_idx = [x for idx_tuple in repeat_idx for x in idx_tuple]
 
         # Resample if idx duplicates or if any idx is in both repeat_idx and unique_idx.
@@ -514,17 +526,46 @@ def give_feedback_freqCount(current_event, response, good, bad):
 
     return perfo_code, trial_performance
 
+def shift_onsets(sequence_log, shift):
+    '''
+    Shifts the onsets of a sequence log from generate_soundtrack.
+
+    Parameters:
+    - sequence_log: Log lines with the onset (sec) in the first column, tab-separated.
+    - shift: The shift in sec.
+
+    Returns:
+    - The log lines with the shifted onsets.
+    '''
+    lines = []
+    for line in sequence_log.splitlines(keepends=True):
+        onset, rest = line.split("\t", 1)
+        lines.append(f"{float(onset) + shift}\t{rest}")
+    return "".join(lines)
+
+def save_seed(seed_seq, log_path):
+    '''
+    Saves the entropy of the session's SeedSequence next to the logs of a block or localizer run.
+
+    Parameters:
+    - seed_seq: The SeedSequence of the session.
+    - log_path: Common path of the logs of the run, with its unique timestamp (_seed.json is appended).
+    '''
+    seed_path = Path(f"{log_path}_seed.json")
+    seed_path.parent.mkdir(parents=True, exist_ok=True)
+    seed_path.write_text(json.dumps({"entropy": seed_seq.entropy, "combo": comboID, "session": sesID}, indent=2))
+
 # 03. LOAD STIMULI -----------------------------------------------------------------------
 # Load audio stimuli for localizer
 audio_root    = Path(params["AUDIO_ROOT"])
-wav_filepaths = list(Path(params["AUDIO_ROOT"]).glob(params["AUDIOFILE_REGEX"]))
+wav_filepaths = sorted(Path(params["AUDIO_ROOT"]).glob(params["AUDIOFILE_REGEX"])) # sorted: glob order depends on the file system
 
 # Rule: sounds include "s3" in filename & silences "null".
 filenames_sounds = [file_1 for file_1 in wav_filepaths if "s3" in str(file_1)]
 filename_null    = [file_2 for file_2 in wav_filepaths if "null" in str(file_2)][0]
 
 # Shuffle the sounds
-random.shuffle(filenames_sounds)
+loc_rng.shuffle(filenames_sounds)
 
 # Load the trial parameters from csv for main task
 homePath  = Path(params["PROJECT_ROOT"])
@@ -603,7 +644,8 @@ silence = stimuli.Audio(str(filename_null))
 sounds  = {filename: stimuli.Audio(str(filename)) for filename in filenames_sounds}
 
 # Get sounds for main task: initialize soung generation (SoundGen) class
-sound_gen = sg.SoundGen(params["SAMPLE_RATE"], params["TAU"])
+sound_gen = sg.SoundGen(params["SAMPLE_RATE"], params["TAU"], dtype=params["AUDIO_DTYPE"], device_rate=params["DEVICE_RATE"], seed=seed_seq, sync=params["SYNC_CHANNEL"])
+block_cache = sg.BlockCache(homePath / params["BLOCK_CACHE_DIR"])
 
 # Preload to ensure fast stimuli presentation.
 blank_canvas.preload(); scanner_text.preload()
@@ -619,14 +661,15 @@ canvas.preload()
 
 # Create preloaded soundtrack for the localizer
 ## Pair sound ID names (for expyriment presentation) and filenames (for data storage).
-sound_strata = random.sample(list(sounds.items()), params["SOUND_STRATA"])
-sound_strata = dict(sound_strata)
+sound_items  = list(sounds.items())
+sound_strata = dict(sound_items[i] for i in loc_rng.choice(len(sound_items), params["SOUND_STRATA"], replace=False))
 reversed_strata = {value: key for key, value in sound_strata.items()} # Works because values are unique!
 soundtrack = create_soundtrack(
     sound_strata = list(sound_strata.values()),
     sequence_len = params["SOUNDS_PER_SEQUENCE"],
     rep_prob     = params["SOUND_REP_PROB"],
-    sequence_no  = params["LOC_TRIALS"] * params["LOC_REP"]
+    sequence_no  = params["LOC_TRIALS"] * params["LOC_REP"],
+    rng          = loc_rng
     )
 
 # 06. RUN THE EXPERIMENT -----------------------------------------------------------------
@@ -661,6 +704,7 @@ if main_task_on:
         # Initialize unique timestamps for logs
         nw = datetime.now()
         ts = int(nw.timestamp())
+        save_seed(seed_seq, Path(f"bids_output_{comboID:003d}") / f"sub-{exp.subject:02d}_ses-{sesID:02d}_task-timDev_ts-{ts}_block-{block_idx:02d}")
 
         # Initialize a dict to track performance on block-level
         trial_performance = {"CORRECT": 0, "INCORRECT": 0}
@@ -689,66 +733,98 @@ if main_task_on:
 
         # Play all tone sequences: trial by trial
         block_start_time = exp.clock.time - task_start_time
+
+        # Upcoming trials are rendered in the background while a trial plays and responses are collected
+        trials = sg.Prefetcher(
+            sound_gen.generate_soundtrack(df_block, block_start_time, params["MAX_AMPLITUDE"], params["NUM_HARMONICS"],  params["TONE_DURATION"],  params["HARMONIC_FACTOR"], params["TONE_LOUDNESS"], block_cache=block_cache, lazy=True),
+            depth = params["PREFETCH_DEPTH"], budget = params["RENDER_BUDGET"], trials = df_block
+            )
         
-        for soundarray, ITI, freq_dev_no, trial_log, time_end in sound_gen.generate_soundtrack(df_block, block_start_time, params["MAX_AMPLITUDE"], params["NUM_HARMONICS"],  params["TONE_DURATION"],  params["HARMONIC_FACTOR"], params["TONE_LOUDNESS"]):
+        # One output stream for the whole block: every trial is scheduled at its onset in the block
+        # timeline (ITIs are sample counts), and the next trial is queued while responses are collected.
+        start_of = lambda trial: int(round(trial[4] * sound_gen.output_rate)) - len(trial[0])
+        stream = sg.BlockStream(sound_gen.output_rate, channels=2 if params["SYNC_CHANNEL"] else 1, dtype=sound_gen.output_dtype)
+        onset_shift = None # msec the block timeline is played after block_start_time (measured at the first trial)
+        with stream:
+            for (soundarray, ITI, freq_dev_no, trial_log, time_end), playback in stream.play(trials, start_of):
 
-            # Refresh the screen
-            canvas.present()
+                # Refresh the screen
+                canvas.present()
 
-            # Check if quit key is pressed during the trial
-            keyboard.check(keys=[misc.constants.K_y])
+                # Check if quit key is pressed during the trial
+                keyboard.check(keys=[misc.constants.K_y])
 
-            # Play the soundtrack
-            sd.play(soundarray, samplerate = params["SAMPLE_RATE"])
+                # Wait until the end of each trial (the trial was started by the stream)
+                playback.wait()
 
-            # Wait until the end of each trial
-            sd.wait()
+                # Initialize variables for logging task performance on trial-level
+                response, rt = None, None
+                max_response_time   = ITI
+                stream_time         = stream.time
+                response_time_start = clock.time
 
-            # Initialize variables for logging task performance on trial-level
-            response, rt = None, None
-            max_response_time   = ITI
-            response_time_start = clock.time
+                # The first trial starts LEAD plus the output latency after it was scheduled, not at
+                # block_start_time: the onsets of the block are logged shifted by its DAC onset
+                if onset_shift is None:
+                    dac_onset   = exp.clock.time - task_start_time + (playback.dac_time - stream_time) * 1000
+                    onset_shift = dac_onset - playback.start / sound_gen.output_rate * 1000
 
-            # Align the clocks
-            time_end_msec = time_end * 1000
-            offset_ms   = response_time_start - time_end_msec
+                # Align the clocks at the time the last sample reached the DAC (wait returns earlier)
+                time_end_msec = time_end * 1000 + onset_shift
+                dac_end_msec  = response_time_start + (playback.end_dac_time - stream_time) * 1000
+                offset_ms     = dac_end_msec - time_end_msec
 
-            # Check for key presses with max response time equal to ITI
-            while clock.time - response_time_start < max_response_time:
+                # Check for key presses with max response time equal to ITI
+                while clock.time - response_time_start < max_response_time:
                 
-                # Non-blocking function to check for pressed keys
-                keys = keyboard.read_out_buffered_keys()
+                    # Non-blocking function to check for pressed keys
+                    keys = keyboard.read_out_buffered_keys()
 
-                # ------ Key-press trials ------ 
-                if keys and keys[0] != 115:  # 115 is "s" from scanner sync box
-                    response = keys[-1]      # If multiple, we take the last key
+                    # ------ Key-press trials ------ 
+                    if keys and keys[0] != 115:  # 115 is "s" from scanner sync box
+                        response = keys[-1]      # If multiple, we take the last key
                     
-                    # Get time of key press
-                    key_press_raw = clock.time
-                    key_press_corr = key_press_raw - offset_ms
-                    key_press_time = key_press_corr / 1000
+                        # Get time of key press
+                        key_press_raw = clock.time
+                        key_press_corr = key_press_raw - offset_ms
+                        key_press_time = key_press_corr / 1000
                     
-                    # Get reaction time
-                    rt = (clock.time - response_time_start) / 1000
-
-                    # Show feedback
-                    perfo_code, trial_performance = give_feedback_freqCount(
-                        freq_dev_no, # Actual number of frequency deviants
-                        response,    # Participant's count
-                        correct,     # Fixation cross for correct responses
-                        wrong        # Fixation cross for incorrect responses
-                    )
-
-                    # Log with correction of the response for MRI buttons (1 is 0 devs, ...)
-                    response = response - 1
-                    freqDev_log.write(f"{key_press_time}\t100\t{chr(response)}\t{rt}\n")
-
-            # Update count of sound trials for percentage correct
-            if not np.isnan(freq_dev_no):
-                no_sound_trials += 1
-
-            # Write relevant info to log for tones
-            timDev_log.write(f"{trial_log}")
+                        # Get reaction time
+                        rt = (clock.time - response_time_start) / 1000
+
+                        # Show feedback
+                        perfo_code, trial_performance = give_feedback_freqCount(
+                            freq_dev_no, # Actual number of frequency deviants
+                            response,    # Participant's count
+                            correct,     # Fixation cross for correct responses
+                            wrong        # Fixation cross for incorrect responses
+                        )
+
+                        # Log with correction of the response for MRI buttons (1 is 0 devs, ...)
+                        response = response - 1
+                        freqDev_log.write(f"{key_press_time}\t100\t{chr(response)}\t{rt}\n")
+
+                # Update count of sound trials for percentage correct
+                if not np.isnan(freq_dev_no):
+                    no_sound_trials += 1
+
+                # Write relevant info to log for tones
+                timDev_log.write(shift_onsets(trial_log, onset_shift / 1000))
+
+        # Check that no trial waited for synthesis (only the first one waits for the block)
+        trials.close()
+        print(f"Block {block_idx} prefetch: {trials.stats()}")
+        print(f"Block {block_idx} render budget overruns: {len(trials.overruns)}")
+        print(f"Block {block_idx} playback: {stream.stats()}")
+
+        # DAC time of every trial (stream clock) next to its scheduled onset
+        dac_log = pd.DataFrame({
+            "trial_no": df_block["trial_no"].to_numpy()[:len(stream.trials)],
+            "scheduled": [playback.start / sound_gen.output_rate for playback in stream.trials],
+            "dac_time": [playback.dac_time for playback in stream.trials],
+            "late_frames": [playback.late for playback in stream.trials],
+            })
+        dac_log.to_csv(Path(f"bids_output_{comboID:003d}") / f"sub-{exp.subject:02d}_ses-{sesID:02d}_task-timDev_ts-{ts}_block-{block_idx:02d}_dac.tsv", sep="\t", index=False)
         
         # Rename the logs according to BIDS standard
         timDev_log.rename(f"sub-{exp.subject:02d}_ses-{sesID:02d}_task-timDev_ts-{ts}_events.tsv")
@@ -808,7 +884,7 @@ if localizer_on:
     task_name = "repetition detection"
     
     # Decide randomly to start with silence or sound.
-    start_with_sound = random.choice([True, False])
+    start_with_sound = bool(loc_rng.integers(2))
 
     # Present instructions for the repetition detection task.
     # Wait a minimal time needed to read the instructions.
@@ -827,6 +903,7 @@ if localizer_on:
         # Initialize the log with unique timestamps
         nw = datetime.now()
         ts = int(nw.timestamp())
+        save_seed(seed_seq, Path(f"bids_output_{comboID:003d}") / f"sub-{exp.subject:02d}_ses-{sesID:02d}_task-localizer_ts-{ts}")
         localizer_log = io.OutputFile(suffix = sesh, directory = f'bids_output_{comboID:003d}')
         localizer_log.write("onset\tduration\tstim_file\ttrial_type\tresponse_time\n")
         run_performance = {"H": 0, "M": 0, "CR": 0, "FA": 0}
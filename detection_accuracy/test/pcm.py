@@ -0,0 +1,50 @@
+#! /usr/bin/env python
+# Time-stamp: <17-10-2026>
+'''
+pcm module quantizes float waveforms to integer PCM (used by create_soundtrack_soundgen
+and the WAV scripts, without importing sounddevice).
+'''
+import numpy as np
+
+def quantize_pcm(sound, bits=16, dither=True, rng=None):
+    """
+    Quantize a float waveform (full scale = 1.0) to integer PCM.
+
+    16-bit PCM is returned as int16. 24-bit PCM is returned as int32 with the
+    24 significant bits in the top of the word, which is how soundfile
+    (subtype "PCM_24") and sounddevice ("int32") expect it.
+
+    :param sound: np.array, input waveform
+    :param bits: int, bit depth (16 or 24)
+    :param dither: bool, add triangular (TPDF) dither of +/- 1 LSB before rounding
+    :param rng: np.random.Generator used for the dither
+
+    :return: pcm: an integer array with the quantized waveform
+    :return: report: a dictionary with the number of clipped samples and the peak of the input
+    """
+    if bits not in (16, 24):
+        raise ValueError(f"Only 16 and 24 bit PCM are supported, not {bits}.")
+
+    full_scale = 2 ** (bits - 1)
+    scaled = np.asarray(sound, dtype=float) * full_scale
+
+    # TPDF dither: difference of two uniform variables, +/- 1 LSB
+    if dither:
+        rng = rng or np.random.default_rng()
+        scaled += rng.random(scaled.shape) - rng.random(scaled.shape)
+
+    scaled = np.round(scaled)
+    clipped = np.count_nonzero((scaled < -full_scale) | (scaled > full_scale - 1))
+    np.clip(scaled, -full_scale, full_scale - 1, out=scaled)
+
+    if bits == 16:
+        pcm = scaled.astype(np.int16)
+    else:
+        pcm = scaled.astype(np.int32) << 8
+
+    report = {
+        "clipped": int(clipped),
+        "peak": float(np.max(np.abs(sound))) if np.size(sound) else 0.0,
+        }
+
+    return pcm, report
@@ -0,0 +1,214 @@
+#! /usr/bin/env python
+# Time-stamp: <17-10-2026>
+'''
+Pre-render the audio of every session in a trials directory.
+
+For every ses-XXX_exp_parameter_combo.csv, each block is rendered with
+SoundGen.render_block into the BlockCache that the main task reads
+(PROJECT_ROOT/block_cache), and the tone log of each block (onsets relative
+to the block start) is written next to it. Sessions run in parallel in a
+ProcessPoolExecutor (one worker per core by default). A session whose CSV and
+audio parameters have not changed since the last run is skipped.
+
+The manifest of a session stores the sha256 of its audio (session_hash). With --verify,
+every session is regenerated from its CSV, seed and audio parameters (without the
+cache) and checked against that hash, so the audio need not be archived.
+
+Disk cost: blocks are stored whole, ITIs and silent trials included, as raw samples
+(output dtype at DEVICE_RATE, x 2 with the sync channel). A block of 108 trials is
+about 12 min of audio, i.e. about 140 MB in float32 at 48 kHz and 0.56 GB per
+4-block session, so 150 sessions need about 85 GB. The size of every session and
+the total are printed. The cached blocks can be deleted once the sessions have been
+run (the main task renders a missing block again).
+
+Usage:
+    python prerender_sessions.py --trials-dir ../trials --workers 8
+    python prerender_sessions.py --trials-dir ../trials --verify
+'''
+
+import os
+import sys
+import ast
+import json
+import time
+import hashlib
+import argparse
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Import the external sequence generation file for the main task
+import create_soundtrack_soundgen as sg
+
+# Audio parameters: must match the main task, otherwise the main task misses the cache
+params = {
+    "TRIALS_DIR"      : "/home/mutrosa/Documents/projects/auditory_paradigms/detection_accuracy/trials",
+    "CACHE_DIR"       : "/home/mutrosa/Documents/projects/auditory_paradigms/detection_accuracy/test/block_cache",
+    "TRIALS_REGEX"    : "ses-*_exp_parameter_combo.csv",
+    "TONE_LOUDNESS"   : 85,     # dB SPL
+    "TONE_DURATION"   : 50,     # msec
+    "NUM_HARMONICS"   : 10,     # Number of harmonics
+    "HARMONIC_FACTOR" : 0.8,    # Harmonic amplitude decay factor
+    "MAX_AMPLITUDE"   : 1.14,   # Defined through a simulation
+    "SAMPLE_RATE"     : 48000,  # Hz, tones are synthesized at this rate
+    "DEVICE_RATE"     : 48000,  # Hz, change depending on the speakers (tones are resampled)
+    "TAU"             : 5,      # Ramping window in msec
+    "AUDIO_DTYPE"     : "float32", # Played by sounddevice without conversion
+    "SYNC_CHANNEL"    : False,  # Second output channel with sync markers
+    "SEED"            : None,   # Entropy of the SeedSequence (dither of PCM audio only)
+}
+
+AUDIO_KEYS = ["TONE_LOUDNESS", "TONE_DURATION", "NUM_HARMONICS", "HARMONIC_FACTOR", "MAX_AMPLITUDE",
+              "SAMPLE_RATE", "DEVICE_RATE", "TAU", "AUDIO_DTYPE", "SYNC_CHANNEL", "SEED"]
+
+def load_trials(path):
+    """ Load the trial parameters from csv, as the main task does. """
+    df = pd.read_csv(path)
+
+    # Ensure that the trials are ordered by block & trial IDs
+    df.sort_values(by=["block_no", "trial_no"], inplace=True)
+
+    # Ensure correct data types in columns with lists as row values.
+    list_cols = ["freq_dev", "freq_dev_type", "freq_loc", "freq_diff", "freq_diff_abs"]
+    for col in list_cols:
+        df[col] = df[col].apply(
+        lambda x: ast.literal_eval(x) if isinstance(x, str) else x
+        )
+
+    return df
+
+def session_setup(params, seed):
+    """ SoundGen (with the np.random.SeedSequence seed) and tone parameters of the main task. """
+    sound_gen = sg.SoundGen(params["SAMPLE_RATE"], params["TAU"], dtype=params["AUDIO_DTYPE"],
+                            device_rate=params["DEVICE_RATE"], seed=seed, sync=params["SYNC_CHANNEL"])
+    tone_params = (params["MAX_AMPLITUDE"], params["NUM_HARMONICS"], params["TONE_DURATION"],
+                   params["HARMONIC_FACTOR"], params["TONE_LOUDNESS"])
+    return sound_gen, tone_params
+
+def prerender_session(csv_path, cache_dir, params):
+    """
+    Render all blocks of one session into the block cache and write the block logs.
+    Skipped if the manifest of the session matches the CSV and the audio parameters.
+
+    :return: (session name, number of blocks, True if it was rendered / False if skipped,
+        size of the cached blocks in bytes)
+    """
+    csv_path, cache_dir = Path(csv_path), Path(cache_dir)
+    session = csv_path.name.split("_")[0]
+    manifest_path = cache_dir / f"{session}_manifest.json"
+
+    # Inputs of the session: the CSV file and the audio parameters
+    inputs = {
+        "csv_sha256": hashlib.sha256(csv_path.read_bytes()).hexdigest(),
+        "audio": {key: params[key] for key in AUDIO_KEYS},
+        "version": sg.BlockCache.VERSION,
+        }
+
+    if manifest_path.exists():
+        manifest = json.loads(manifest_path.read_text())
+        if manifest["inputs"] == inputs and all((cache_dir / f"{key}.npy").exists() for key in manifest["blocks"]):
+            return session, len(manifest["blocks"]), False, blocks_size(cache_dir, manifest["blocks"])
+
+    block_cache = sg.BlockCache(cache_dir)
+    sound_gen, tone_params = session_setup(params, np.random.SeedSequence(params["SEED"]))
+
+    df = load_trials(csv_path)
+    keys = []
+    digest = hashlib.sha256() # same as sg.session_hash
+    for block_idx in sorted(df["block_no"].unique()):
+        df_block = df[df["block_no"] == block_idx]
+
+        # Render the block (onsets relative to the block start)
+        block, timeline, _ = sound_gen.render_block(df_block, 0, *tone_params, block_cache=block_cache)
+        keys.append(block_cache.key(sound_gen, df_block, 0, tone_params))
+        digest.update(np.ascontiguousarray(block).tobytes())
+
+        # Tone log of the block
+        lines = sound_gen.timeline_log(df_block, timeline, params["TONE_DURATION"])
+        log_path = cache_dir / f"{session}_block-{block_idx:02d}_events.tsv"
+        log_path.write_text("onset\tduration\ttrial_type\n" + "".join(lines))
+
+    manifest = {
+        "inputs": inputs,
+        "blocks": keys,
+        "seed": [sound_gen.seed_sequence.entropy, list(sound_gen.seed_sequence.spawn_key)],
+        "audio_sha256": digest.hexdigest(),
+        }
+    manifest_path.write_text(json.dumps(manifest, indent=2))
+
+    return session, len(keys), True, blocks_size(cache_dir, keys)
+
+def blocks_size(cache_dir, keys):
+    """ Size in bytes of the cached blocks with the given keys. """
+    return sum((Path(cache_dir) / f"{key}.npy").stat().st_size for key in keys)
+
+def verify_session(csv_path, cache_dir):
+    """
+    Regenerate the audio of one session from its CSV, the seed and the audio parameters
+    of its manifest (not from the block cache) and compare its hash with the stored one.
+
+    :return: (session name, True if the hash matches / False if not, message)
+    """
+    csv_path, cache_dir = Path(csv_path), Path(cache_dir)
+    session = csv_path.name.split("_")[0]
+    manifest_path = cache_dir / f"{session}_manifest.json"
+    if not manifest_path.exists():
+        return session, False, "no manifest, pre-render the session first"
+
+    manifest = json.loads(manifest_path.read_text())
+    if hashlib.sha256(csv_path.read_bytes()).hexdigest() != manifest["inputs"]["csv_sha256"]:
+        return session, False, "the CSV changed since it was pre-rendered"
+
+    # Parameters and seed as recorded in the manifest
+    entropy, spawn_key = manifest["seed"]
+    seed = np.random.SeedSequence(entropy, spawn_key=tuple(spawn_key))
+    sound_gen, tone_params = session_setup(manifest["inputs"]["audio"], seed)
+
+    digest = sg.session_hash(sound_gen, load_trials(csv_path), tone_params)
+    if digest != manifest["audio_sha256"]:
+        return session, False, f"hash mismatch ({digest[:12]} != {manifest['audio_sha256'][:12]})"
+
+    return session, True, f"audio_sha256 {digest[:12]} ok"
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pre-render the audio of all sessions in a trials directory.")
+    parser.add_argument("--trials-dir", default=params["TRIALS_DIR"], help="Folder with ses-XXX_exp_parameter_combo.csv files.")
+    parser.add_argument("--cache-dir", default=params["CACHE_DIR"], help="Block cache of the main task.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of processes (default: one per core).")
+    parser.add_argument("--verify", action="store_true", help="Regenerate every session and check it against the hash in its manifest.")
+    args = parser.parse_args()
+
+    csv_paths = sorted(Path(args.trials_dir).glob(params["TRIALS_REGEX"]))
+
+    if args.verify:
+        print(f"Verifying {len(csv_paths)} sessions with {args.workers} workers against {args.cache_dir}")
+        failed = 0
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            futures = [pool.submit(verify_session, path, args.cache_dir) for path in csv_paths]
+            for future in as_completed(futures):
+                session, ok, message = future.result()
+                failed += not ok
+                print(f"{session}: {message}")
+        print(f"Done: {len(csv_paths) - failed} verified, {failed} failed.")
+        sys.exit(1 if failed else 0)
+
+    Path(args.cache_dir).mkdir(parents=True, exist_ok=True)
+    print(f"Pre-rendering {len(csv_paths)} sessions with {args.workers} workers into {args.cache_dir}")
+
+    start = time.perf_counter()
+    rendered, skipped, size = 0, 0, 0
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = [pool.submit(prerender_session, path, args.cache_dir, params) for path in csv_paths]
+        for future in as_completed(futures):
+            session, no_blocks, was_rendered, session_size = future.result()
+            rendered += was_rendered
+            skipped += not was_rendered
+            size += session_size
+            print(f"{session}: {no_blocks} blocks {'rendered' if was_rendered else 'unchanged, skipped'} "
+                  f"({session_size / 1e6:.0f} MB)")
+
+    minutes = (time.perf_counter() - start) / 60
+    print(f"Done: {rendered} rendered, {skipped} skipped in {minutes * 60:.1f} s "
+          f"({(rendered + skipped) / minutes:.1f} sessions/minute, {rendered / minutes:.1f} rendered sessions/minute).")
+    print(f"Cached blocks of these sessions: {size / 1e9:.2f} GB in {args.cache_dir}.")
@@ -1,8 +1,13 @@
 import os
 import re
+import sys
 import numpy as np
 from scipy.io.wavfile import read, write
 
+# quantize_pcm is shared with create_soundtrack_soundgen (test/pcm.py)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "test"))
+from pcm import quantize_pcm
+
 #### EURIA'S CODE: check check needed
 def parse_filename(filename):
     """
@@ -29,16 +34,23 @@ def parse_filename(filename):
         }
     return None
 
-def combine_wav_files_per_run_trial(folder_path, output_folder=None):
+def combine_wav_files_per_run_trial(folder_path, output_folder=None, seed=None):
     """
     Scans a folder for WAV files, groups them by run and trial, 
     sorts them by sequence index first, then by type (tone -> isi),
     to create an alternating tone-isi-tone-isi sequence.
+
+    The dither of float files comes from one SeedSequence (seed: its entropy, None draws
+    it from the OS). The entropy is printed; each run/trial gets its own child seed,
+    so the files can be combined again bit-exactly in any order.
     """
     if not os.path.exists(folder_path):
         print(f"Error: Folder '{folder_path}' not found.")
         return
 
+    seed_seq = np.random.SeedSequence(seed)
+    print(f"Seed entropy: {seed_seq.entropy}")
+
     if output_folder is None:
         output_folder = folder_path
     
@@ -89,13 +101,15 @@ def combine_wav_files_per_run_trial(folder_path, output_folder=None):
         # Define output filename
         output_filename = os.path.join(output_folder, f"combined_run-{run_idx:02d}_trial-{trial_idx:02d}.wav")
         
-        # Call the combination logic
-        combine_audio_list(file_paths, output_filename)
+        # Call the combination logic (dither seeded by run and trial)
+        rng = np.random.default_rng(np.random.SeedSequence(seed_seq.entropy, spawn_key=(run_idx, trial_idx)))
+        combine_audio_list(file_paths, output_filename, rng)
 
-def combine_audio_list(file_paths, output_filename):
+def combine_audio_list(file_paths, output_filename, rng=None):
     """
     Internal helper to combine a specific list of files into one output.
     (Adapted from your provided snippet)
+    rng: np.random.Generator for the dither of float files.
     """
     if not file_paths:
         return
@@ -120,8 +134,10 @@ def combine_audio_list(file_paths, output_filename):
             # Normalize dtype to int16
             if data.dtype != np.int16:
                 if np.issubdtype(data.dtype, np.floating):
-                    # Scale float to int16 range
-                    data = (data * 32767).astype(np.int16)
+                    # Scale float to int16 range (dithered, with clipping report)
+                    data, report = quantize_pcm(data, 16, rng=rng)
+                    if report["clipped"]:
+                        print(f"Warning: {report['clipped']} samples clipped in {os.path.basename(file_path)}.")
                 else:
                     data = data.astype(np.int16)
             
@@ -144,4 +160,5 @@ def combine_audio_list(file_paths, output_filename):
 
 # --- Usage Example ---
 AUDIO_FOLDER = "/home/mutrosa/Documents/projects/auditory_paradigms/detection_accuracy/stimuli_segments/"
-combine_wav_files_per_run_trial(AUDIO_FOLDER)
\ No newline at end of file
+SEED = None # Entropy of the dither SeedSequence (None: drawn from the OS and printed)
+combine_wav_files_per_run_trial(AUDIO_FOLDER, seed=SEED)
\ No newline at end of file
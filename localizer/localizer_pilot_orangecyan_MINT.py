@@ -15,10 +15,11 @@ sesh = input("Enter the session number with 0 prefixed (e.g.: 01, 02):")
 now = datetime.now()
 tis = int(now.timestamp())
 
-# Use current time to seed both random generators
-seed = int(tis * 1000) % 2**32
-random.seed(seed)
-np.random.seed(seed)
+# Use current time as the entropy of one SeedSequence and seed both random generators from it.
+# The entropy is saved in the experiment info, so a session can be generated again from it.
+seed_seq = np.random.SeedSequence(tis)
+random.seed(int(seed_seq.generate_state(1, np.uint64)[0]))
+np.random.seed(seed_seq.spawn(1)[0].generate_state(1)[0])
 
 # Speficy BIDS-formatted EventFile
 # onset [msec], duration [msec], stim_file [wav], response [HIT, ...]
@@ -434,6 +435,7 @@ filename_silence = ["stimuli" + file_2.split("stimuli", 1)[1] for file_2 in wav_
 
 # 4. INITIALIZE THE EXPERIMENT ----------------------------------------------------------
 exp = design.Experiment(name = "localizer")
+exp.add_experiment_info(f"seed entropy: {seed_seq.entropy}")
 control.initialize(exp)
 
 # 5. CREATE & PRELOAD THE STIMULI -------------------------------------------------------
@@ -12,7 +12,6 @@ TODO: this code is not updated to create sounds with frequency deviants.
 '''
 
 #1: INSTALL LIBRARIES
-import random
 import numpy as np
 import soundfile as sf
 import sounddevice as sd
@@ -43,9 +42,16 @@ params = {
     "TONE_DURATION"   : 100,    # Duration of each tone in msec
     "TONE_FREQUENCY"  : 440,    # Equivalent to A musical tone
     "NO_TONES"        : 7,      # Informed by iterative singing preferences: 10.1016/j.cub.2023.02.070
+    "SEED"            : None,   # Entropy of the SeedSequence of all random draws (None: drawn from the OS)
 }
 
 #4: GENERATE ISI & DELTAS
+# Every random draw (empty trials, shuffles, displaced tones) comes from one SeedSequence.
+# With the printed entropy and these parameters, all .wav files can be generated again.
+seed_seq = np.random.SeedSequence(params["SEED"])
+rng = np.random.default_rng(seed_seq.spawn(1)[0])
+print(f"Seed entropy: {seed_seq.entropy}")
+
 #Generate a list of inter-stimulus-intervals (ISI)
 isi_list = list(np.arange(params_interest["ISI_min"],
                           params_interest["ISI_max"], 
@@ -70,20 +76,20 @@ aboveT     = np.sum(deltas_abs > params_interest["threshold"])
 no_empty = aboveT - belowT
 if no_empty > 0:
     possible_empty = np.setdiff1d(np.arange(-params_interest["threshold"], params_interest["threshold"], dtype = np.int64), deltas)
-    empty  = np.random.choice(possible_empty, size = no_empty, replace = False)
+    empty  = rng.choice(possible_empty, size = no_empty, replace = False)
     deltas = np.concatenate([deltas, empty])
     
 deltas = np.sort(deltas)
 
 #Generate core sound stimuli
-sound_gen = sg.SoundGen(params["SAMPLE_RATE"], params["TAU"])
+sound_gen = sg.SoundGen(params["SAMPLE_RATE"], params["TAU"], seed=seed_seq)
 
 #5: GENERATE SEQUENCES
-random.shuffle(isi_list)
+rng.shuffle(isi_list)
 for block, current_isi in enumerate(isi_list):
 
     # Shuffle deltas per block
-    random.shuffle(deltas)
+    rng.shuffle(deltas)
 
     for trial, current_delta in enumerate(deltas):
 
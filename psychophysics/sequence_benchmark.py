@@ -0,0 +1,84 @@
+#! /usr/bin/env python
+# Time-stamp: <17-10-2026>
+'''
+Benchmark of SoundGen.generate_sequence against the earlier version,
+which grew the sequence with np.concatenate inside the tone loop.
+
+Prints the time per sequence for an increasing number of tones and checks
+that both versions return the same sequence (same seed).
+The time per tone of generate_sequence stays flat (linear scaling).
+'''
+
+import timeit
+import numpy as np
+
+import stimuli_generation as sg
+
+params = {
+    "SAMPLE_RATE"     : 48000,  # Sampling rate in Hz
+    "TAU"             : 5,      # Ramping window in msec
+    "FREQ"            : 392,    # Frequency in Hz
+    "MAX_AMPLITUDE"   : 1.1,
+    "NUM_HARMONICS"   : 5,
+    "TONE_DURATION"   : 50,     # msec
+    "HARMONIC_FACTOR" : 0.7,
+    "ISI"             : 500,    # msec
+    "DELTA"           : -40,    # msec
+    "DBSPL"           : 70,
+    "NO_TONES"        : [8, 16, 32, 64, 128, 256, 512],
+    "REPEATS"         : 3,
+}
+
+def concatenate_sequence(sound_gen, freq, max_amplitude, num_harmonics, tone_duration, harmonic_factor, isi, no_tones, delta, dbspl):
+    """ Earlier generate_sequence: the sequence grows by one tone and one ISI per iteration. """
+    isi = isi / 1000
+    delta = delta / 1000
+    tone_duration = tone_duration / 1000
+
+    sound = sound_gen.sound_maker(freq, max_amplitude, num_harmonics, tone_duration, harmonic_factor, dbspl)
+    ramped_sound = sound_gen.sine_ramp(sound)
+
+    isi_samples   = int(isi * sound_gen.sample_rate)
+    delta_samples = int(delta * sound_gen.sample_rate)
+    tone_samples  = int(tone_duration * sound_gen.sample_rate)
+    total_samples = int(tone_samples * no_tones + (no_tones - 1) * isi_samples)
+
+    displaced_tone = int(sound_gen.rng.integers(4, no_tones))
+
+    sequence = np.array([], dtype=sound_gen.dtype)
+    for tone_idx in range(no_tones):
+        sequence = np.concatenate((sequence, ramped_sound))
+
+        current_isi = isi_samples
+        if tone_idx == displaced_tone - 2:
+            if delta > 0:
+                current_isi = isi_samples + delta_samples
+            elif delta < 0:
+                current_isi = isi_samples - delta_samples
+        elif tone_idx == displaced_tone - 1:
+            if delta > 0:
+                current_isi = isi_samples - delta_samples
+            elif delta < 0:
+                current_isi = isi_samples + delta_samples
+
+        sequence = np.concatenate((sequence, np.zeros(current_isi, dtype=sound_gen.dtype)))
+
+    return sequence, displaced_tone, total_samples
+
+if __name__ == "__main__":
+    sound_gen = sg.SoundGen(params["SAMPLE_RATE"], params["TAU"])
+
+    print(f"{'tones':>6} {'concatenate (ms)':>17} {'preallocated (ms)':>18} {'per tone (us)':>14}")
+    for no_tones in params["NO_TONES"]:
+        args = (params["FREQ"], params["MAX_AMPLITUDE"], params["NUM_HARMONICS"], params["TONE_DURATION"],
+                params["HARMONIC_FACTOR"], params["ISI"], no_tones, params["DELTA"], params["DBSPL"])
+
+        # Both versions must give the same sequence
+        old = concatenate_sequence(sg.SoundGen(params["SAMPLE_RATE"], params["TAU"], seed=no_tones), *args)
+        new = sg.SoundGen(params["SAMPLE_RATE"], params["TAU"], seed=no_tones).generate_sequence(*args)
+        if not (np.array_equal(old[0], new[0]) and old[1:] == new[1:]):
+            raise RuntimeError(f"Sequences differ for {no_tones} tones.")
+
+        old_time = min(timeit.repeat(lambda: concatenate_sequence(sound_gen, *args), number=1, repeat=params["REPEATS"]))
+        new_time = min(timeit.repeat(lambda: sound_gen.generate_sequence(*args), number=1, repeat=params["REPEATS"]))
+        print(f"{no_tones:>6} {old_time * 1000:>17.2f} {new_time * 1000:>18.2f} {new_time / no_tones * 1e6:>14.1f}")
@@ -7,35 +7,55 @@ import numpy as np
 import sounddevice as sd
 
 # Replacement for thorns
-def set_dbspl(sound, dbspl, ref=20e-6):
+def set_dbspl(sound, dbspl, ref=20e-6, out=None):
     """
     Normalize waveform to target dB SPL.
 
-    :param sound : np.array, input waveform
-    :param dbspl: float, desired sound level in dB SPL
+    :param sound : np.array, input waveform (1D, or 2D with one tone per row)
+    :param dbspl: float, desired sound level in dB SPL (for 2D input: one value per row, shape (tones, 1))
     :param max_peak: float, max peak
     :param ref : float, reference pressure (default 20 µPa)
+    :param out: np.array, optional array of the same shape to write the result into (may be sound itself)
+    The output keeps the dtype of the input waveform.
     """
 
-    # Apply dB SPL scaling (RMS based)
-    rms = np.sqrt(np.mean(sound**2))
-    target_rms = ref * (10 ** (dbspl / 20))
-    scale = target_rms / rms
-    scaled_sound = sound * scale
+    # Apply dB SPL scaling (RMS based). For 2D input (tones x samples),
+    # each row is normalized separately.
+    rms = np.sqrt(np.mean(sound**2, axis=-1, keepdims=True))
+    target_rms = ref * (10 ** (np.asarray(dbspl) / 20))
+    scale = np.asarray(target_rms / rms, dtype=sound.dtype)
+    scaled_sound = np.multiply(sound, scale, out=out)
 
     return scaled_sound
 
 class SoundGen:
-    def __init__(self, sample_rate, tau):
+    def __init__(self, sample_rate, tau, dtype=np.float64, seed=None):
         """
         Initialize the CreateSound instance.
         :param sample_rate: Sample rate of sounds ( per second).
         :param tau: The ramping window in milliseconds.
+        :param dtype: Floating point type of all generated audio (e.g. np.float32 for sounddevice).
+        :param seed: Seed (int or np.random.SeedSequence) of the random draws of generate_sequence.
+            self.seed_sequence.entropy records it; None draws fresh entropy from the OS.
         """
         self.sample_rate = sample_rate
         self.tau = tau / 1000
+        self.dtype = np.dtype(dtype)
+        self.seed_sequence = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+        self.rng = np.random.default_rng(self.seed_sequence)
 
-    def sound_maker(self, freq, max_amplitude, num_harmonics, tone_duration, harmonic_factor, dbspl):
+    def _phase(self, freqs, t):
+        """
+        Phase 2 pi f t of the base frequencies in the dtype of the instance.
+        For single precision it is wrapped to one cycle (in float64) before the cast,
+        which keeps the phase of long tones accurate.
+        """
+        phase = 2 * np.pi * freqs * t
+        if self.dtype != np.float64:
+            phase = np.mod(phase, 2 * np.pi).astype(self.dtype)
+        return phase
+
+    def sound_maker(self, freq, max_amplitude, num_harmonics, tone_duration, harmonic_factor, dbspl, out=None):
         """
         :param sample_rate: Sample rate in Hz.
         :param freq: Base frequency in Hz.
@@ -44,32 +64,88 @@ class SoundGen:
         :param tone_duration: Duration of each tone in seconds.
         :param harmonic_factor: Harmonic amplitude decay factor for each tone.
         :param dbspl: Desired dbspl (loudness) level.
+        :param out: Optional array (e.g. a slice of a sequence buffer) to build the tone in.
         :return: normalized_sound: array of audio samples representing the harmonic complex tone.
         """
         # Create the time array
         t = np.linspace(0, tone_duration, int(self.sample_rate * tone_duration),
                         endpoint = False)
         
-        # Initialize the sound array
-        sound = np.zeros_like(t)
+        # Phase of the base frequency
+        phase = self._phase(freq, t)
+
+        # Initialize the sound array (or the caller's buffer)
+        if out is None:
+            sound = np.zeros_like(phase)
+        else:
+            if out.shape != phase.shape:
+                raise ValueError(f"out has shape {out.shape}, but the tone has {len(phase)} samples.")
+            sound = out
+            sound[...] = 0
 
         # Generate the harmonics
         for k in range(1, num_harmonics + 1):
-            harmonic = np.sin(2 * np.pi * freq * k * t)
+            harmonic = np.sin(k * phase)
             amplitude = max_amplitude * (harmonic_factor ** (k - 1)) / num_harmonics
             sound += amplitude * harmonic
 
         # Normalize the sound (without throns due to dependency conflicts)
-        normalized_sound = set_dbspl(sound, dbspl)
+        normalized_sound = set_dbspl(sound, dbspl, out=out)
         
         return normalized_sound
 
-    def sine_ramp(self, sound):
+    def sound_maker_batch(self, freqs, max_amplitude, num_harmonics, tone_duration, harmonic_factor, dbspl):
+        """
+        Vectorized version of sound_maker for many base frequencies.
+        The harmonics of all tones are computed in one pass over a
+        (tones x harmonics x samples) grid; repeated frequencies are synthesized once.
+
+        :param freqs: Sequence of base frequencies in Hz.
+        :param max_amplitude: Maximum amplitude to avoid distortions or clipping.
+        :param num_harmonics: Number of harmonic tones.
+        :param tone_duration: Duration of each tone in seconds.
+        :param harmonic_factor: Harmonic amplitude decay factor for each tone.
+        :param dbspl: Desired dbspl (loudness) level, one value or one value per tone.
+        :return: normalized_sounds: 2D array (tones x samples), one harmonic complex tone per row.
+        """
+        freqs = np.asarray(freqs, dtype=float).ravel()
+        dbspl = np.broadcast_to(np.asarray(dbspl, dtype=float), freqs.shape)
+
+        # Create the time array
+        t = np.linspace(0, tone_duration, int(self.sample_rate * tone_duration),
+                        endpoint = False)
+
+        # Synthesize every unique frequency only once
+        unique_freqs, inverse = np.unique(freqs, return_inverse=True)
+
+        # Generate the harmonics on a (tones x harmonics x samples) grid
+        k = np.arange(1, num_harmonics + 1)
+        amplitudes = max_amplitude * (harmonic_factor ** (k - 1)) / num_harmonics
+        phase = self._phase(unique_freqs[:, None], t[None, :])
+        harmonics = np.sin(k.astype(self.dtype)[None, :, None] * phase[:, None, :])
+        sounds = np.einsum("h,fhn->fn", amplitudes.astype(self.dtype), harmonics)
+
+        # Normalize each tone separately
+        normalized_sounds = set_dbspl(sounds[inverse], dbspl[:, None])
+
+        return normalized_sounds
+
+    def sine_ramp(self, sound, out=None):
+        """
+        Apply the sine ramp to the start and end of the sound.
+        The ramped sound is a copy, or out (e.g. a slice of a sequence buffer) if given.
+        """
         L = int(self.tau * self.sample_rate)
         t = np.linspace(0, L / self.sample_rate, L)
         sine_window = np.sin(np.pi * t / (2 * self.tau)) ** 2  # Sine fade-in
-
-        sound = sound.copy()
+        sine_window = sine_window.astype(self.dtype)
+
+        if out is None:
+            sound = sound.astype(self.dtype) # copy
+        else:
+            if out is not sound:
+                out[...] = sound
+            sound = out
         sound[:L] *= sine_window         # Apply fade-in
         sound[-L:] *= sine_window[::-1]  # Apply fade-out
 
@@ -77,6 +153,19 @@ class SoundGen:
 
     #Sequence generation, with one displaced tone 
     def generate_sequence(self, freq, max_amplitude, num_harmonics, tone_duration, harmonic_factor, isi, no_tones, delta, dbspl):
+        """
+        Generate a sequence of no_tones identical tones, each followed by an ISI,
+        where the tone displaced_tone (1-based, picked at random) is shifted by delta.
+
+        All onsets are computed first; the sequence is allocated once and the
+        tones are copied into place, so the cost is linear in the number of tones.
+
+        :param isi: Inter-stimulus interval in msec.
+        :param no_tones: Number of tones in the sequence.
+        :param delta: Timing deviation of the displaced tone in msec.
+        :return: sequence (ends with one ISI of silence), displaced_tone and
+            total_samples (tones and regular ISIs between them, without the deviation).
+        """
 
         # Convert to sec (input must be in msec)
         isi = isi / 1000
@@ -97,43 +186,34 @@ class SoundGen:
         total_samples = int(tone_samples * no_tones + (no_tones - 1) * isi_samples)
          
         # Pick a random tone to displace
-        displaced_tone = np.random.randint(4, no_tones)
-
-        # Generate sequence with ISI gaps between each tone
-        sequence = np.array([])
-
-        for tone_idx in range(no_tones):
-            
-            # ----------------- Adding tones ------------------
-            sequence = np.concatenate((sequence, ramped_sound))
-
-            # ----------------- Adding ISI --------------------
-            # Regular isi
-            current_isi = isi_samples
-
-            # Change the ISI before the displaced tone
-            if tone_idx == displaced_tone - 2:
-                
-                # Positive delta (delay)
-                if delta > 0:
-                    current_isi = isi_samples + delta_samples
-
-                # Negative delta (advance)
-                elif delta < 0:
-                    current_isi = isi_samples - delta_samples
-            
-            # Change the ISI after the displaced tone
-            elif tone_idx == displaced_tone - 1:
-                
-                # Positive delta (shorten after the delayed tone)
-                if delta > 0:
-                    current_isi = isi_samples - delta_samples
-
-                # Negative delta (prolong after the delayed tone)
-                elif delta < 0:
-                    current_isi = isi_samples + delta_samples
-
-            sequence = np.concatenate((sequence, np.zeros(current_isi)))
+        displaced_tone = int(self.rng.integers(4, no_tones))
+
+        # ----------------- ISI after each tone --------------------
+        # Regular isi (the last tone is followed by one as well)
+        isis = np.full(no_tones, isi_samples)
+
+        # Change the ISI before and after the displaced tone
+        # Positive delta (delay): prolong before, shorten after the delayed tone
+        if delta > 0:
+            isis[displaced_tone - 2] = isi_samples + delta_samples
+            isis[displaced_tone - 1] = isi_samples - delta_samples
+
+        # Negative delta (advance)
+        elif delta < 0:
+            isis[displaced_tone - 2] = isi_samples - delta_samples
+            isis[displaced_tone - 1] = isi_samples + delta_samples
+
+        if np.any(isis < 0):
+            raise ValueError(f"Delta ({delta * 1000:g} ms) is larger than the ISI ({isi * 1000:g} ms).")
+
+        # ----------------- Tone onsets --------------------
+        segments = len(ramped_sound) + isis
+        onsets = np.concatenate(([0], np.cumsum(segments)[:-1]))
+
+        # Generate sequence with ISI gaps between each tone (silence everywhere, tones copied in)
+        sequence = np.zeros(segments.sum(), dtype=self.dtype)
+        for onset in onsets:
+            sequence[onset:onset + len(ramped_sound)] = ramped_sound
 
         return sequence, displaced_tone, total_samples
         
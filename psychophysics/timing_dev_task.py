@@ -5,7 +5,6 @@
 # Testing detection accuracy for deviant tones 
 
 #1: INSTALL LIBRARIES
-import random
 import numpy as np
 import sounddevice as sd
 from datetime import datetime 
@@ -86,6 +85,11 @@ exp.add_data_variable_names(['SUB_ID', 'SESSION_NO', 'BLOCK_NO', 'TRIAL_NO',
 now = datetime.now() 
 ts  = int(now.timestamp()) 
 
+# The timestamp (in the output filenames) is the entropy of the SeedSequence of all random draws,
+# so the stimuli of a session can be generated again from it.
+seed_seq = np.random.SeedSequence(ts)
+rng = np.random.default_rng(seed_seq.spawn(1)[0])
+
 #6:CREATE STIMULI
 # Create general experiment features and preload them for faster presentation
 keyboard = io.Keyboard()
@@ -132,12 +136,12 @@ aboveT     = np.sum(deltas_abs > params_interest["threshold"])
 no_empty   = aboveT - belowT
 if no_empty > 0:
     possible_empty = np.setdiff1d(np.arange(-params_interest["threshold"], params_interest["threshold"], dtype = np.int64), deltas)
-    empty  = np.random.choice(possible_empty, size = no_empty, replace = False)
+    empty  = rng.choice(possible_empty, size = no_empty, replace = False)
     deltas = np.concatenate([deltas, empty])
 deltas = np.sort(deltas)
 
 # Generate core sound stimuli
-sound_gen = sg.SoundGen(params["SAMPLE_RATE"], params["TAU"]) 
+sound_gen = sg.SoundGen(params["SAMPLE_RATE"], params["TAU"], seed=seed_seq) 
 
 #7: RUN EXPERIMENT 
 control.start(skip_ready_screen = True)
@@ -153,12 +157,12 @@ keyboard.wait(keys = [misc.constants.K_SPACE])
 cross.present()
 
 # Randomize the order of ISI in blocks per experimental session (run)
-random.shuffle(isi_list)
+rng.shuffle(isi_list)
 
 for block, current_isi in enumerate(isi_list):
 
     # Shuffle deltas per block
-    random.shuffle(deltas)
+    rng.shuffle(deltas)
 
     for trial, current_delta in enumerate(deltas):
         cross.present()